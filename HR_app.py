@@ -1,36 +1,22 @@
 # HR_app.py
 import uuid
 import streamlit as st
+from functools import lru_cache
 
-from HR_sql_ai import HRTextToSQLEngine, ENGINE_VERSION
-from scenario_payroll import ScenarioMemoryManager, PayrollScenario, ScenarioOrchestrator
+from HR_sql_ai import HRTextToSQLEngine, ENGINE_VERSION, get_llm, load_schema, truncate_result
+from scenario_payroll import ScenarioMemoryManager, PayrollScenario, ScenarioOrchestrator, STATE_LABELS
 
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
 
 # =====================================================
-# 유틸: 메시지 → 턴 구조
+# 유틸
 # =====================================================
-def build_turns(messages):
-    turns = []
-    i = 0
-    n = len(messages)
-    while i < n:
-        m = messages[i]
-        if m["role"] == "user":
-            turn = {"user": m, "assistant": None}
-            if i + 1 < n and messages[i + 1]["role"] == "assistant":
-                turn["assistant"] = messages[i + 1]
-                i += 2
-            else:
-                i += 1
-            turns.append(turn)
-        else:
-            turns.append({"user": None, "assistant": m})
-            i += 1
-    return turns
+@lru_cache(maxsize=128)
+def _chip_keys(key_prefix: str, labels: tuple) -> tuple:
+    """칩 버튼 위젯 키: 같은 제안 목록이면 rerun마다 문자열을 다시 만들지 않고 재사용"""
+    return tuple(f"{key_prefix}_{i}_{label}" for i, label in enumerate(labels))
 
 
 def render_action_chips(suggestions, key_prefix="act"):
@@ -38,53 +24,39 @@ def render_action_chips(suggestions, key_prefix="act"):
     if not suggestions:
         return None
 
-    shown = suggestions[:4]
+    shown = tuple(suggestions[:4])
     cols = st.columns(len(shown))
-    for i, label in enumerate(shown):
-        if cols[i].button(label, key=f"{key_prefix}_{i}_{label}", use_container_width=True):
+    for col, label, key in zip(cols, shown, _chip_keys(key_prefix, shown)):
+        if col.button(label, key=key, use_container_width=True):
             return label
     return None
 
 
+def render_sql_expanders(sql, raw_sql):
+    """assistant 말풍선 아래 실행/원본 SQL expander 렌더링"""
+    if sql:
+        with st.expander("🔎 실행된 SQL"):
+            st.code(sql, language="sql")
+
+    if raw_sql:
+        with st.expander("🧪 원본 SQL"):
+            st.code(raw_sql, language="sql")
+
+
 # =====================================================
 # CSS (상단 공백 제거 + 중앙 로딩 오버레이)
 # =====================================================
-st.markdown(
-    """
-    <style>
-    .block-container {
-        padding-top: 0.6rem !important;
-        padding-bottom: 1rem;
-    }
-    @media (max-width: 768px) {
-        .block-container { padding-top: 0.4rem !important; }
-    }
-
-    .nk-overlay {
-        position: fixed;
-        inset: 0;
-        background: rgba(0,0,0,0.08);
-        z-index: 9998;
-    }
-    .nk-center-spinner {
-        position: fixed;
-        top: 50%;
-        left: 50%;
-        transform: translate(-50%, -50%);
-        z-index: 9999;
-        background: rgba(255,255,255,0.96);
-        padding: 26px 34px;
-        border-radius: 14px;
-        box-shadow: 0 10px 28px rgba(0,0,0,0.18);
-        text-align: center;
-        font-size: 16px;
-        font-weight: 700;
-        min-width: 260px;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+CSS_PATH = "assets/css/hr_app.css"
+
+
+@st.cache_resource(show_spinner=False)
+def load_css(path: str) -> str:
+    """정적 CSS 파일을 한 번만 읽어 <style> 블록 문자열로 캐시"""
+    with open(path, encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
+
+
+st.markdown(load_css(CSS_PATH), unsafe_allow_html=True)
 
 
 def show_center_spinner(text: str = "처리 중..."):
@@ -102,8 +74,10 @@ def show_center_spinner(text: str = "처리 중..."):
 # =====================================================
 st.set_page_config(page_title="Agentic AI for 넝쿨HR", layout="wide")
 
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+# 대화는 user/assistant 쌍(turn) 단위로 저장 → 렌더 시 짝 맞추기 패스 불필요
+#   {"user_content": str, "assistant_content": str|None, "sql": str|None, "raw_sql": str|None}
+if "turns" not in st.session_state:
+    st.session_state.turns = []
 if "pending_question" not in st.session_state:
     st.session_state.pending_question = None
 if "session_id" not in st.session_state:
@@ -137,9 +111,18 @@ if "[YOUR-PASSWORD]" in db_uri:
 # =====================================================
 # 3) 엔진 / 설명기 (캐시는 유지)
 # =====================================================
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_schema(db_uri: str, version: str) -> str:
+    return load_schema(db_uri, version)
+
+
 @st.cache_resource(show_spinner=False)
 def get_engine(_db_uri: str, _api_key: str, _version: str) -> HRTextToSQLEngine:
-    return HRTextToSQLEngine(db_uri=_db_uri, api_key=_api_key)
+    return HRTextToSQLEngine(
+        db_uri=_db_uri,
+        api_key=_api_key,
+        schema=get_schema(_db_uri, _version),
+    )
 
 
 @st.cache_resource(show_spinner=False)
@@ -155,11 +138,7 @@ SQL 결과: {result}
     )
     return (
         prompt
-        | ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            google_api_key=_api_key,
-            temperature=0
-        )
+        | get_llm(_api_key)
         | StrOutputParser()
     )
 
@@ -167,6 +146,48 @@ SQL 결과: {result}
 engine = get_engine(db_uri, api_key, ENGINE_VERSION)
 explainer = get_explainer(api_key)
 
+
+# ============================
+# 일반 질의 캐시 (대표 질문 반복 클릭 대응)
+#   - ENGINE_VERSION이 키에 포함되어 스키마/프롬프트 변경 시 자동 무효화
+#   - 시나리오 단계는 상태 의존이라 캐시하지 않음
+#   - DB/연결 오류 결과는 일시적일 수 있으므로 캐시하지 않음
+# ============================
+def is_error_result(out: dict) -> bool:
+    """engine.run 결과가 실행 오류("Error: ..." 문자열 또는 error 키)인지"""
+    result = out.get("result")
+    return "error" in out or (isinstance(result, str) and result.startswith("Error:"))
+
+
+class _UncachedResult(Exception):
+    """cache_data에 저장하지 않을 결과를 예외로 캐시 함수 밖까지 전달 (예외는 캐시되지 않음)"""
+
+    def __init__(self, out: dict):
+        super().__init__("uncached result")
+        self.out = out
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_sql_run(question: str, version: str) -> dict:
+    out = engine.run(question)
+    if is_error_result(out):
+        raise _UncachedResult(out)
+    return out
+
+
+def cached_sql_run(question: str, version: str) -> dict:
+    try:
+        return _cached_sql_run(question, version)
+    except _UncachedResult as e:
+        return e.out
+
+
+@st.cache_resource(ttl=300, show_spinner=False)
+def get_explain_cache(_version: str) -> dict:
+    """(question, result) → 설명 텍스트. 스트리밍을 유지하려고 dict로 직접 관리"""
+    return {}
+
+
 # ============================
 # 시나리오 메모리 / 오케스트레이터
 # ============================
@@ -176,6 +197,7 @@ payroll_scenario = PayrollScenario(memory)
 orchestrator = ScenarioOrchestrator(
     sql_engine=engine,
     scenarios=[payroll_scenario],
+    fallback_run=lambda q: cached_sql_run(q, ENGINE_VERSION),
 )
 
 
@@ -195,19 +217,12 @@ st.markdown(
 # =====================================================
 # 🧭 시나리오 상태 바 + 종료
 # =====================================================
-STATE_LABEL = {
-    "PAYROLL_CALC": "급여 산정",
-    "TAX_CALC": "공제 검증",
-    "PAYMENT_RUN": "지급 처리",
-    "JOURNAL_POST": "전표 생성",
-    "DONE": "완료",
-}
-
 ctx = st.session_state.get("scenario_memory", {}).get(st.session_state.session_id)
 
 if ctx and ctx.get("active_scenario"):
     state = ctx.get("state")
-    st.info(f"🧭 현재 작업: 급여 처리 · 단계: {STATE_LABEL.get(state, state)}")
+    label = STATE_LABELS[state] if isinstance(state, int) else state
+    st.info(f"🧭 현재 작업: 급여 처리 · 단계: {label}")
 
     if st.button("❌ 시나리오 종료"):
         memory.clear(st.session_state.session_id)
@@ -232,48 +247,45 @@ chip_questions = [
     "2025년 12월 부서별 실수령 총액은?",
 ]
 
-cols = st.columns(2)
-for i, q in enumerate(chip_questions):
-    with cols[i % 2]:
-        if st.button(q, use_container_width=True, key=f"chip_{i}"):
-            st.session_state.pending_question = q
-            st.rerun()
+
+
+def _on_chip_selected():
+    # 선택값을 질문으로 넘기고 pills 선택은 해제 (같은 칩 재클릭 가능하도록)
+    st.session_state.pending_question = st.session_state.chip_pills
+    st.session_state.chip_pills = None
+
+
+# 10개 버튼 대신 단일 pills 위젯 → 프론트엔드 diff/이벤트 1회
+st.pills(
+    "대표 질문",
+    chip_questions,
+    key="chip_pills",
+    on_change=_on_chip_selected,
+    label_visibility="collapsed",
+)
 
 st.divider()
 
 
 # =====================================================
 # 6) 기존 대화 표시
+#   - 히스토리는 최신 turn이 위 → 이번 run의 새 turn 자리를 히스토리 위에 미리 확보
 # =====================================================
-turns = build_turns(st.session_state.messages)
-
-for t in reversed(turns):
-    if t["user"]:
-        with st.chat_message("user"):
-            st.markdown(t["user"]["content"])
+live_turn = st.container()
 
-    if t["assistant"]:
-        with st.chat_message("assistant"):
-            st.markdown(t["assistant"]["content"])
 
-            if t["assistant"].get("sql"):
-                with st.expander("🔎 실행된 SQL"):
-                    st.code(t["assistant"]["sql"], language="sql")
+def render_history():
+    for t in reversed(st.session_state.turns):
+        with st.chat_message("user"):
+            st.markdown(t["user_content"])
 
-            if t["assistant"].get("raw_sql"):
-                with st.expander("🧪 원본 SQL"):
-                    st.code(t["assistant"]["raw_sql"], language="sql")
+        if t["assistant_content"] is not None:
+            with st.chat_message("assistant"):
+                st.markdown(t["assistant_content"])
+                render_sql_expanders(t.get("sql"), t.get("raw_sql"))
 
 
-# =====================================================
-# 6.5) 시나리오 다음 작업(액션 칩) 표시
-#   - out 변수를 여기서 쓰지 않음 (NameError 방지)
-# =====================================================
-clicked = render_action_chips(st.session_state.action_suggestions, key_prefix="next")
-if clicked:
-    st.session_state.pending_question = clicked
-    st.session_state.action_suggestions = []
-    st.rerun()
+render_history()
 
 
 # =====================================================
@@ -291,13 +303,20 @@ elif user_input:
 
 # =====================================================
 # 8) 실행 (Scenario → fallback SQL)
+#   - 결과는 같은 run에서 바로 렌더 (추가 st.rerun 없음)
 # =====================================================
 if question:
-    st.session_state.messages.append({"role": "user", "content": question})
+    with live_turn:
+        with st.chat_message("user"):
+            st.markdown(question)
+        assistant_box = st.chat_message("assistant")
 
+    # session_state 쓰기는 끝에서 한 번에 반영 (중간 변경 최소화)
     out = {}
     sql = None
     raw_sql = None
+    suggestions = []
+    streamed = False
 
     try:
         spinner = show_center_spinner("처리 중...")
@@ -318,14 +337,23 @@ if question:
             # ✅ 시나리오 단계는 reply를 그대로(LLM 해설로 인한 오해 방지)
             answer = out.get("reply", "")
 
-            # ✅ 다음 작업 가이드 저장 → 다음 rerun에서 버튼으로 표시
-            st.session_state.action_suggestions = out.get("suggestions", []) or []
+            # ✅ 다음 작업 가이드 → 아래 액션 칩으로 표시
+            suggestions = out.get("suggestions", []) or []
         else:
-            # ✅ 일반 질의만 explainer 요약
-            answer = explainer.invoke({"question": question, "result": result})
-
-            # 일반 질의는 액션칩 비움
-            st.session_state.action_suggestions = []
+            # ✅ 일반 질의만 explainer 요약 (토큰 단위 스트리밍 → 첫 토큰부터 바로 표시)
+            explain_cache = get_explain_cache(ENGINE_VERSION)
+            result_text = truncate_result(result)
+            explain_key = (question, result_text)
+            answer = explain_cache.get(explain_key)
+            if answer is None:
+                with assistant_box:
+                    answer = st.write_stream(
+                        explainer.stream({"question": question, "result": result_text})
+                    )
+                streamed = True
+                # 오류 결과에 대한 설명은 캐시하지 않음 (일시적 오류가 5분간 반복되지 않도록)
+                if not is_error_result(artifacts):
+                    explain_cache[explain_key] = answer
 
         sql = artifacts.get("fixed_sql")
         raw_sql = artifacts.get("raw_sql")
@@ -337,13 +365,27 @@ if question:
             pass
 
         answer = f"❌ 오류: {e}"
-        st.session_state.action_suggestions = []
 
-    st.session_state.messages.append({
-        "role": "assistant",
-        "content": answer,
+    st.session_state.turns.append({
+        "user_content": question,
+        "assistant_content": answer,
         "sql": sql,
         "raw_sql": raw_sql,
     })
+    st.session_state.action_suggestions = suggestions
+
+    with assistant_box:
+        if not streamed:
+            st.markdown(answer)
+        render_sql_expanders(sql, raw_sql)
 
+
+# =====================================================
+# 9) 시나리오 다음 작업(액션 칩) 표시
+#   - 실행(8) 이후에 그려서 이번 run에서 갱신된 제안이 바로 보이도록
+# =====================================================
+clicked = render_action_chips(st.session_state.action_suggestions, key_prefix="next")
+if clicked:
+    st.session_state.pending_question = clicked
+    st.session_state.action_suggestions = []
     st.rerun()
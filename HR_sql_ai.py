@@ -1,9 +1,21 @@
+import hashlib
+import os
 import re
+import tempfile
+import time
 import uuid
+from datetime import date, datetime
+from functools import lru_cache
 from typing import Optional
 
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
 from langchain_community.utilities import SQLDatabase
-from langchain_community.tools import QuerySQLDatabaseTool
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
@@ -15,28 +27,43 @@ from scenario_payroll import (
     ScenarioOrchestrator,
 )
 
-ENGINE_VERSION = "v2026-01-08-05"  # ✅ 시나리오 통합 버전
+ENGINE_VERSION = "v2026-01-08-07"  # ✅ pay_month 범위 보정을 엔진 후처리로 이동
+
+# LLM 호출 결과를 디스크(SQLite)에 캐시 → 같은 프롬프트 재호출 시 Gemini 왕복 생략
+# (프로세스 재시작에도 유지, 운영에서 끄려면 LLM_CACHE_ENABLED=0)
+if os.getenv("LLM_CACHE_ENABLED", "1") == "1":
+    from langchain_core.globals import set_llm_cache
+    from langchain_community.cache import SQLiteCache
+
+    set_llm_cache(SQLiteCache(database_path=os.getenv("LLM_CACHE_PATH", ".langchain.db")))
 
 # =====================================================
 # 0) SQL 정제 및 보정
 # =====================================================
+_FENCE_HEAD = re.compile(r"^```[a-zA-Z0-9_+-]*\s*", re.IGNORECASE)
+_FENCE_TAIL = re.compile(r"\s*```$")
+_SQL_PREFIX = re.compile(r"^\s*(sql|postgres|postgresql)\s*:?\s*", re.IGNORECASE)
+_LEADING_STMT = re.compile(r"\b(select|with)\b", re.IGNORECASE)
+
+_DATE_DUP_QUOTE = re.compile(r"'(\d{4}-\d{2}-\d{2})'+")
+_DATE_DATE = re.compile(r"\bDATE\s+DATE\b", re.IGNORECASE)
+_DATE_UNQUOTED = re.compile(r"\bDATE\s+(\d{4}-\d{2}-\d{2})", re.IGNORECASE)
+_INTERVAL_UNQUOTED = re.compile(r"\bINTERVAL\s+(\d+)\s+(day|days)", re.IGNORECASE)
+_INTERVAL_DUP_QUOTE = re.compile(r"INTERVAL\s+'([^']*)'+", re.IGNORECASE)
+
+
 def strip_code_fence(s: str) -> str:
     s = (s or "").strip()
-    s = re.sub(r"^```[a-zA-Z0-9_+-]*\s*", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"\s*```$", "", s)
+    s = _FENCE_HEAD.sub("", s)
+    s = _FENCE_TAIL.sub("", s)
     return s.strip()
 
 
 def normalize_sql(s: str) -> str:
     s = strip_code_fence(s)
-    s = re.sub(
-        r"^\s*(sql|postgres|postgresql)\s*:?\s*",
-        "",
-        s,
-        flags=re.IGNORECASE,
-    ).strip()
-
-    m = re.search(r"\b(select|with)\b", s, flags=re.IGNORECASE)
+    s = _SQL_PREFIX.sub("", s).strip()
+
+    m = _LEADING_STMT.search(s)
     if m:
         s = s[m.start():].strip()
 
@@ -46,53 +73,212 @@ def normalize_sql(s: str) -> str:
 def fix_postgres_date_sql(sql: str) -> str:
     sql = strip_code_fence(sql).strip()
 
-    sql = re.sub(r"'(\d{4}-\d{2}-\d{2})'+", r"'\1'", sql)
-    sql = re.sub(r"\bDATE\s+DATE\b", "DATE", sql, flags=re.IGNORECASE)
-    sql = re.sub(
-        r"\bDATE\s+(\d{4}-\d{2}-\d{2})",
-        r"DATE '\1'",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    sql = re.sub(
-        r"\bINTERVAL\s+(\d+)\s+(day|days)",
-        r"INTERVAL '\1 \2'",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    sql = re.sub(
-        r"INTERVAL\s+'([^']*)'+",
-        r"INTERVAL '\1'",
-        sql,
-        flags=re.IGNORECASE,
-    )
+    sql = _DATE_DUP_QUOTE.sub(r"'\1'", sql)
+    sql = _DATE_DATE.sub("DATE", sql)
+    sql = _DATE_UNQUOTED.sub(r"DATE '\1'", sql)
+    sql = _INTERVAL_UNQUOTED.sub(r"INTERVAL '\1 \2'", sql)
+    sql = _INTERVAL_DUP_QUOTE.sub(r"INTERVAL '\1'", sql)
 
     return sql
 
 
+# pay_month 범위 보정(안전망) 사용 여부: 프롬프트만으로 충분하면 PAY_MONTH_RANGE_FIX=0으로 끔
+PAY_MONTH_RANGE_FIX = os.getenv("PAY_MONTH_RANGE_FIX", "1") == "1"
+
+
+def _month_bounds(d: date):
+    """
+    일자가 속한 달의 월초, 다음달 월초(date)를 튜플로 반환한다.
+    예: 2026-01-15 -> (2026-01-01, 2026-02-01)
+    """
+    month_start = d.replace(day=1)
+    if month_start.month == 12:
+        next_month = month_start.replace(year=month_start.year + 1, month=1)
+    else:
+        next_month = month_start.replace(month=month_start.month + 1)
+    return month_start, next_month
+
+
+# pay_month '일자 박기' 조건 패턴 (세 가지 표기를 하나의 alternation으로 → SQL을 한 번만 스캔)
+#   a) pay_month = DATE 'YYYY-MM-DD'
+#   b) pay_month = 'YYYY-MM-DD'::date
+#   c) pay_month = DATE('YYYY-MM-DD')
+_MONTH_PAT = re.compile(
+    r"pay_month\s*=\s*(?:"
+    r"DATE\s*'(?P<a>\d{4}-\d{2}-\d{2})'"
+    r"|'(?P<b>\d{4}-\d{2}-\d{2})'\s*::\s*date"
+    r"|DATE\s*\(\s*'(?P<c>\d{4}-\d{2}-\d{2})'\s*\)"
+    r")",
+    flags=re.IGNORECASE
+)
+
+
+def _repl_month(m) -> str:
+    """
+    매칭된 pay_month 일자 조건을 해당 월 범위 조건(월초 이상 ~ 다음달 월초 미만)으로 변환
+    """
+    dt = datetime.strptime(m.group(m.lastgroup), "%Y-%m-%d").date()
+    ms, nm = _month_bounds(dt)
+    return f"pay_month >= DATE '{ms:%Y-%m-%d}' AND pay_month < DATE '{nm:%Y-%m-%d}'"
+
+
+def enforce_month_range_sql(sql: str) -> str:
+    """
+    SQL 내부에 pay_month = 'YYYY-MM-DD' 처럼 '일자 박기' 조건이 있으면,
+    pay_month가 속한 월 전체 범위로 치환(월초 ~ 다음달월초 미만)하여 반환한다.
+    (SQL_PROMPT가 범위 조건을 직접 쓰도록 안내하므로 여기서는 안전망 역할만 한다)
+    범위 조건은 pay_month 일반 B-tree 인덱스를 그대로 탄다 (date_trunc 함수 인덱스 불필요)
+    """
+    if not sql or "pay_month" not in sql.lower():
+        return sql
+
+    return _MONTH_PAT.sub(_repl_month, sql)
+
+
+_READONLY_HEADS = ("select", "with")
+# AST에 하나라도 있으면 차단하는 문장 유형 (DML/DDL, 파싱 못한 명령)
+_WRITE_NODES = (
+    exp.Insert,
+    exp.Update,
+    exp.Delete,
+    exp.Merge,
+    exp.Drop,
+    exp.Alter,
+    exp.Create,
+    exp.TruncateTable,
+    exp.Command,
+)
+
+
+def _touches_pg_internals(node: exp.Expression) -> bool:
+    """pg_sleep()/pg_read_file() 같은 함수나 pg_catalog 등 시스템 스키마 접근 여부"""
+    if isinstance(node, exp.Func):
+        name = node.name if isinstance(node, exp.Anonymous) else node.sql_name()
+        return name.lower().startswith("pg_")
+    if isinstance(node, exp.Table):
+        return node.name.lower().startswith("pg_") or node.db.lower().startswith("pg_")
+    return False
+
+
+@lru_cache(maxsize=128)
+def _parse_single(sql: str) -> Optional[exp.Expression]:
+    """
+    단일 SQL 문을 postgres 방언으로 파싱 (문장이 여러 개거나 파싱 실패면 None).
+    안전검사와 행 상한 부여가 같은 문자열을 연달아 다루므로 파싱은 한 번만.
+    반환된 트리는 공유되므로 변경하지 말 것 (limit() 등은 복사본을 만든다)
+    """
+    try:
+        statements = [st for st in sqlglot.parse(sql, read="postgres") if st is not None]
+    except SqlglotError:
+        return None
+    return statements[0] if len(statements) == 1 else None
+
+
+# 결과 행 상한: LIMIT 없는 조회에 자동 부여 (전송량/설명 프롬프트 토큰 절감)
+RESULT_ROW_LIMIT = int(os.getenv("SQL_RESULT_ROW_LIMIT", "200"))
+
+
+def cap_result_rows(sql: str, limit: int = RESULT_ROW_LIMIT) -> str:
+    """
+    최상위 문장에 LIMIT/FETCH가 없을 때만 LIMIT 부여.
+    서브쿼리/CTE 안의 LIMIT은 바깥 결과 행 수를 제한하지 않으므로 AST 최상위 노드로 판단.
+    """
+    root = _parse_single(sql.strip())
+    if not isinstance(root, exp.Query):
+        return sql
+    if root.args.get("limit") or root.args.get("fetch"):
+        return sql
+    return root.limit(limit).sql(dialect="postgres") + ";"
+
+
+EXPLAIN_RESULT_MAX_CHARS = 4000
+
+
+def truncate_result(result, max_chars: int = EXPLAIN_RESULT_MAX_CHARS) -> str:
+    """
+    설명(explainer) 프롬프트에 넣을 SQL 결과를 앞부분만 남겨 입력 토큰을 줄인다.
+    (요약 용도라 전체 행이 필요하지 않음)
+    """
+    s = "" if result is None else str(result)
+    if len(s) <= max_chars:
+        return s
+    return s[:max_chars] + "\n... (truncated, showing first rows)"
+
+
 def is_safe_readonly_sql(sql: str) -> bool:
-    if not sql:
+    s = (sql or "").strip()
+    if not s:
         return False
 
-    lowered = sql.lower().strip()
-
-    if len([p for p in lowered.split(";") if p.strip()]) != 1:
+    # 전체 lower() 없이 앞 6글자만으로 SELECT/WITH 판별 (가장 싼 검사부터)
+    if not s[:6].lower().startswith(_READONLY_HEADS):
         return False
 
-    if not (lowered.startswith("select") or lowered.startswith("with")):
+    # 한 번 파싱해서 AST로 판별: 주석/문자열/컬럼명(updated_at 등) 오탐 없음
+    root = _parse_single(s)
+    if not isinstance(root, exp.Query):
         return False
 
-    forbidden = [
-        "insert",
-        "update",
-        "delete",
-        "drop",
-        "alter",
-        "create",
-        "truncate",
-        "pg_",
-    ]
-    return not any(tok in lowered for tok in forbidden)
+    for node in root.walk():
+        if isinstance(node, _WRITE_NODES) or _touches_pg_internals(node):
+            return False
+    return True
+
+
+# get_table_info()의 샘플 행 블록(/* N rows from ... */)과 연속 빈 줄
+_SCHEMA_COMMENT_BLOCK = re.compile(r"/\*.*?\*/", re.DOTALL)
+_SCHEMA_BLANK_LINES = re.compile(r"\n\s*\n+")
+
+
+def compact_schema(schema: str) -> str:
+    """
+    스키마 문자열에서 샘플 행 주석/빈 줄을 제거해 프롬프트 입력 토큰을 줄인다.
+    (DDL 자체는 그대로 유지)
+    """
+    s = _SCHEMA_COMMENT_BLOCK.sub("", schema or "")
+    return _SCHEMA_BLANK_LINES.sub("\n\n", s).strip()
+
+
+# 압축 스키마 디스크 캐시: 프로세스 재시작(재배포/워커 교체) 후에도 전체 테이블 반영 왕복 생략
+SCHEMA_CACHE_DIR = os.getenv("SCHEMA_CACHE_DIR", tempfile.gettempdir())
+SCHEMA_CACHE_TTL_SEC = int(os.getenv("SCHEMA_CACHE_TTL_SEC", str(24 * 3600)))
+
+
+def _schema_cache_path(db_uri: str, version: str) -> str:
+    # 파일명에 접속 정보가 남지 않도록 URI는 해시로만 구분
+    digest = hashlib.sha1(db_uri.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SCHEMA_CACHE_DIR, f"hr_schema_{version}_{digest}.sql")
+
+
+def load_schema(db_uri: str, version: Optional[str] = None) -> str:
+    """
+    DB를 반영(reflect)해서 압축된 스키마 문자열을 반환.
+    UI 레이어에서 캐시(st.cache_data 등)로 감싸서 사용
+    version을 넘기면 결과를 디스크에 저장하고, TTL 내 파일이 있으면 반영 없이 그대로 읽음
+    (ENGINE_VERSION을 올리면 파일명이 바뀌어 자동 무효화)
+    """
+    path = _schema_cache_path(db_uri, version) if version else None
+    if path:
+        try:
+            if time.time() - os.path.getmtime(path) < SCHEMA_CACHE_TTL_SEC:
+                with open(path, encoding="utf-8") as f:
+                    return f.read()
+        except OSError:
+            pass
+
+    db = SQLDatabase.from_uri(db_uri, sample_rows_in_table_info=0)
+    schema = compact_schema(db.get_table_info())
+
+    if path and schema:
+        # 임시 파일에 쓴 뒤 교체 → 동시에 뜬 워커가 반쯤 쓴 파일을 읽지 않음
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(schema)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+    return schema
 
 
 # =====================================================
@@ -106,6 +292,7 @@ SQL_PROMPT = PromptTemplate.from_template(
 - 오늘 날짜는 DATE '2026-01-08'로 고정해서 사용하십시오.
 - CURRENT_DATE 대신 반드시 DATE '2026-01-08'을 사용하십시오.
 - 날짜 연산 예시: DATE '2026-01-08' - INTERVAL '30 days'
+- pay_month를 조회할 때는 반드시 pay_month >= DATE 'YYYY-MM-01' AND pay_month < DATE '(다음 달)-01' 형태의 범위 조건을 사용하십시오. pay_month = DATE '...' 같은 등호 조건은 절대 쓰지 마십시오.
 - SQL 외의 설명, 주석, 마크다운은 절대 포함하지 마십시오.
 
 스키마:
@@ -118,20 +305,42 @@ SQL:"""
 )
 
 # =====================================================
-# 2) Text → SQL 엔진
+# 2) LLM 클라이언트 (프로세스 내 공유)
 # =====================================================
-class HRTextToSQLEngine:
-    def __init__(self, db_uri: str, api_key: str):
-        self.db = SQLDatabase.from_uri(db_uri)
-        self.executor = QuerySQLDatabaseTool(db=self.db)
-
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            google_api_key=api_key,
-            temperature=0,
-        )
+@lru_cache(maxsize=8)
+def get_llm(api_key: str, model: str = "gemini-2.0-flash", temperature: float = 0.0) -> ChatGoogleGenerativeAI:
+    """
+    (api_key, model, temperature) 조합별로 ChatGoogleGenerativeAI를 한 번만 만들어 재사용.
+    SQL 엔진/설명기/재작성기가 같은 HTTP 세션을 공유해 핸드셰이크 비용을 줄인다.
+    """
+    return ChatGoogleGenerativeAI(
+        model=model,
+        google_api_key=api_key,
+        temperature=temperature,
+    )
 
-        self._schema: Optional[str] = None
+
+# =====================================================
+# 3) Text → SQL 엔진
+# =====================================================
+class HRTextToSQLEngine:
+    def __init__(
+        self,
+        db_uri: str,
+        api_key: str,
+        schema: Optional[str] = None,
+        engine: Optional[Engine] = None,
+    ):
+        # 스키마를 미리 받았으면 테이블 반영(reflection)은 건너뜀 → 콜드 스타트 단축
+        # engine을 넘기면 별도 풀을 만들지 않고 호출 측 커넥션 풀을 그대로 공유
+        if engine is None:
+            engine = create_engine(db_uri)
+        self.engine = engine
+        self.db = SQLDatabase(engine, lazy_table_reflection=schema is not None)
+
+        self.llm = get_llm(api_key)
+
+        self._schema: Optional[str] = schema
 
         self.chain = (
             {"schema": lambda _: self.schema, "question": RunnablePassthrough()}
@@ -143,20 +352,44 @@ class HRTextToSQLEngine:
     @property
     def schema(self) -> str:
         if self._schema is None:
-            self._schema = self.db.get_table_info()
+            self._schema = compact_schema(self.db.get_table_info())
         return self._schema
 
-    def run(self, question: str) -> dict:
+    def execute(self, sql: str):
+        """
+        SQL을 엔진에서 직접 실행해 드라이버 행(튜플) 리스트를 반환.
+        repr 문자열로 만들지 않으므로 호출 측 재파싱이 필요 없다.
+        실패 시에는 예외 대신 "Error: ..." 문자열을 반환 (호출 측은 결과 문자열로 오류를 판별).
+        """
+        try:
+            with self.engine.connect() as conn:
+                return [tuple(r) for r in conn.execute(text(sql))]
+        except SQLAlchemyError as e:
+            return f"Error: {e}"
+
+    def run(self, question: str, execute: bool = True) -> dict:
+        """
+        질문 → SQL 생성/정제/안전검사 후 실행.
+        execute=False면 SQL만 만들어 반환 (호출 측이 SQL을 보정해 직접 실행하는 경우)
+          - 이때는 LLM 원본 SQL(raw_sql)도 함께 돌려줘 실행 SQL과 비교해 볼 수 있게 함
+        """
         raw_sql = self.chain.invoke(question)
 
         sql = normalize_sql(raw_sql)
         sql = fix_postgres_date_sql(sql)
+        if PAY_MONTH_RANGE_FIX:
+            sql = enforce_month_range_sql(sql)
 
         if not is_safe_readonly_sql(sql):
             raise ValueError(f"위험한 쿼리 차단됨: {sql}")
 
+        sql = cap_result_rows(sql)
+
+        if not execute:
+            return {"raw_sql": raw_sql, "fixed_sql": sql}
+
         try:
-            result = self.executor.invoke({"query": sql})
+            result = self.execute(sql)
             return {
                 #"raw_sql": raw_sql,
                 "fixed_sql": sql,
@@ -171,7 +404,7 @@ class HRTextToSQLEngine:
 
 
 # =====================================================
-# 3) Scenario + Orchestrator 생성 헬퍼
+# 4) Scenario + Orchestrator 생성 헬퍼
 # =====================================================
 def build_orchestrator(
     db_uri: str,
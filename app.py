@@ -1,6 +1,7 @@
 import os
 import re
 import streamlit as st
+from functools import lru_cache
 from typing import Any, Dict, List, Optional
 
 from langchain_community.utilities import SQLDatabase
@@ -68,7 +69,9 @@ EXPLAIN_PROMPT = ChatPromptTemplate.from_messages([
      "User question: {question}\nSQL executed:\n{sql}\n\nResult:\n{result}\n\nAnswer:")
 ])
 
+@lru_cache(maxsize=4)
 def build_llm(api_key: str):
+    # 질문마다 새 클라이언트를 만들지 않도록 키별로 재사용
     return ChatGoogleGenerativeAI(
         model="gemini-2.0-flash",
         google_api_key=api_key,
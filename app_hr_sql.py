@@ -1,36 +1,29 @@
 # app_hr_sql.py
 import uuid
 import re
-import ast
+import asyncio
 import os
 import tempfile
 import streamlit as st
 import streamlit.components.v1 as components
 import time
+import threading
 import base64
-import fitz  # PyMuPDF
 import hashlib
-import json
+import orjson
+from collections import OrderedDict, deque
+from contextlib import ExitStack
+from types import MappingProxyType
+from functools import lru_cache
 
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
-from reportlab.pdfgen import canvas
-from HR_sql_ai import HRTextToSQLEngine, ENGINE_VERSION
 from scenario_payroll import ScenarioMemoryManager  # 메모리만 재사용
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-
 from datetime import date, datetime
 
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 
 
 # =====================================================
@@ -85,11 +78,25 @@ def _normalize_db_url(url: str) -> str:
     return url
 
 
+# 엔진 생성 시 미리 열어둘 커넥션 수 (psycopg_pool의 min_size와 같은 역할)
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", "2"))
+
+
+def _warm_pool(engine: Engine, n: int) -> None:
+    """
+    커넥션 n개를 동시에 체크아웃했다가 반납 → 풀에 n개가 열린 채로 남는다.
+    (연달아 들어오는 첫 요청들이 각각 TCP/TLS/인증 비용을 떠안지 않도록)
+    """
+    with ExitStack() as stack:
+        for _ in range(n):
+            stack.enter_context(engine.connect())
+
+
 @st.cache_resource(show_spinner=False)
 def get_db_engine() -> Engine:
     """
     환경변수에서 DB 접속 정보를 읽어 SQLAlchemy 엔진을 한 번만 생성하고 캐시한다.
-    커넥션 풀/SSL 등 DB 연결안전설정을 적용해서 엔진 생성.
+    커넥션 풀/SSL 등 DB 연결안전설정을 적용해서 엔진 생성 후 커넥션을 미리 열어둔다.
     """
     db_url = _normalize_db_url(os.getenv("SUPABASE_DB_URI", "").strip())
     if not db_url:
@@ -97,17 +104,36 @@ def get_db_engine() -> Engine:
 
     connect_args = {"connect_timeout": 10}
     connect_args["sslmode"] = os.getenv("DB_SSLMODE", "require")
+    # TCP keepalive: NAT/방화벽이 유휴 커넥션을 끊어 풀 교체(재연결)가 일어나는 것을 방지
+    connect_args["keepalives"] = 1
+    connect_args["keepalives_idle"] = int(os.getenv("DB_KEEPALIVES_IDLE", "30"))
+    connect_args["keepalives_interval"] = 10
+    connect_args["keepalives_count"] = 3
 
+    pool_size = int(os.getenv("DB_POOL_SIZE", "10"))
     engine = create_engine(
         db_url,
-        pool_pre_ping=True,
-        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
-        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
-        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),  # 30분
+        # 체크아웃마다 SELECT 1 왕복을 피하고, 유휴 커넥션은 recycle로 교체 (필요 시 DB_PRE_PING=1)
+        pool_pre_ping=os.getenv("DB_PRE_PING", "0") == "1",
+        # 리런이 몰리는 다중 세션 대비 여유 (Supabase 접속 한도를 넘지 않게 환경변수로 조정)
+        pool_size=pool_size,
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "300")),  # 5분 (PgBouncer 유휴 타임아웃보다 짧게)
         pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        # 최근 반납된(따뜻한) 커넥션부터 재사용 → 남는 커넥션은 유휴로 두었다가 recycle
+        pool_use_lifo=True,
         connect_args=connect_args,
         future=True,
     )
+
+    # 워밍업: 첫 사용자 요청들이 TCP/TLS/인증 비용을 떠안지 않도록 풀에 커넥션 DB_POOL_WARM개 확보
+    #   - pool_size를 넘기면 반납 시 overflow로 닫히거나 체크아웃 대기(pool_timeout)에 걸리므로 상한 적용
+    #   - 워밍업 실패(연결/풀 타임아웃 등)는 엔진 생성을 막지 않음 → 첫 요청에서 다시 연결
+    try:
+        db_ping(engine, retries=1)
+        _warm_pool(engine, min(DB_POOL_WARM, pool_size))
+    except SQLAlchemyError:
+        pass
     return engine
 
 
@@ -130,13 +156,22 @@ def db_ping(engine: Engine, retries: int = 3, backoff_sec: float = 1.2) -> None:
     raise last_err
 
 
+@lru_cache(maxsize=256)
+def _prep(sql: str):
+    """
+    SQL 문자열별 TextClause를 한 번만 만들어 재사용.
+    같은 객체가 들어오므로 SQLAlchemy compiled_cache 키 계산/컴파일도 바로 적중한다.
+    """
+    return text(sql)
+
+
 def fetch_all(sql: str, params: dict | None = None) -> list[dict]:
     """
     SELECT 쿼리를 실행하여 dict형 리스트로 결과를 반환하는 헬퍼 함수.
     """
     engine = get_db_engine()
     with engine.connect() as conn:
-        result = conn.execute(text(sql), params or {})
+        result = conn.execute(_prep(sql), params or {})
         rows = result.mappings().all()
     return [dict(r) for r in rows]
 
@@ -147,7 +182,7 @@ def execute(sql: str, params: dict | None = None) -> int:
     """
     engine = get_db_engine()
     with engine.begin() as conn:
-        result = conn.execute(text(sql), params or {})
+        result = conn.execute(_prep(sql), params or {})
     return int(result.rowcount or 0)
 
 
@@ -210,69 +245,10 @@ def run_scroll_if_requested():
     del st.session_state["_scroll_to_id"]
 
 
-def _month_bounds(d: date):
-    """
-    일자가 속한 달의 월초, 다음달 월초(date)를 튜플로 반환한다.
-    예: 2026-01-15 -> (2026-01-01, 2026-02-01)
-    """
-    month_start = d.replace(day=1)
-    if month_start.month == 12:
-        next_month = month_start.replace(year=month_start.year + 1, month=1)
-    else:
-        next_month = month_start.replace(month=month_start.month + 1)
-    return month_start, next_month
-
-
-def enforce_month_range_sql(sql: str) -> str:
-    """
-    SQL 내부에 pay_month = 'YYYY-MM-DD' 처럼 '일자 박기' 조건이 있으면,
-    pay_month가 속한 월 전체 범위로 치환(월초 ~ 다음달월초 미만)하여 반환한다.
-    """
-    if not sql:
-        return sql
-
-    s = sql
-
-    # 1) pay_month = DATE 'YYYY-MM-DD' 패턴 치환
-    pat1 = re.compile(
-        r"(pay_month\s*=\s*DATE\s*'(\d{4}-\d{2}-\d{2})')",
-        flags=re.IGNORECASE
-    )
-
-    def repl1(m):
-        dt = datetime.strptime(m.group(2), "%Y-%m-%d").date()
-        ms, nm = _month_bounds(dt)
-        return f"pay_month >= DATE '{ms:%Y-%m-%d}' AND pay_month < DATE '{nm:%Y-%m-%d}'"
-
-    s = pat1.sub(repl1, s)
-
-    # 2) pay_month = 'YYYY-MM-DD'::date 패턴 치환
-    pat2 = re.compile(
-        r"(pay_month\s*=\s*'(\d{4}-\d{2}-\d{2})'\s*::\s*date)",
-        flags=re.IGNORECASE
-    )
-
-    def repl2(m):
-        dt = datetime.strptime(m.group(2), "%Y-%m-%d").date()
-        ms, nm = _month_bounds(dt)
-        return f"pay_month >= DATE '{ms:%Y-%m-%d}' AND pay_month < DATE '{nm:%Y-%m-%d}'"
-
-    s = pat2.sub(repl2, s)
-
-    # 3) pay_month = DATE('YYYY-MM-DD') 패턴 치환
-    pat3 = re.compile(
-        r"pay_month\s*=\s*DATE\s*\(\s*'(\d{4}-\d{2}-\d{2})'\s*\)",
-        flags=re.IGNORECASE
-    )
-
-    def repl3(m):
-        dt = datetime.strptime(m.group(1), "%Y-%m-%d").date()
-        ms, nm = _month_bounds(dt)
-        return f"pay_month >= DATE '{ms:%Y-%m-%d}' AND pay_month < DATE '{nm:%Y-%m-%d}'"
-
-    s = pat3.sub(repl3, s)
-
-    return s
+@lru_cache(maxsize=128)
+def _chip_keys(key_prefix: str, labels: tuple) -> tuple:
+    """칩 버튼 위젯 키: 같은 제안 목록이면 rerun마다 문자열을 다시 만들지 않고 재사용"""
+    return tuple(f"{key_prefix}_{i}_{label}" for i, label in enumerate(labels))
 
 
 def render_action_chips(suggestions, key_prefix="act"):
@@ -283,19 +259,23 @@ def render_action_chips(suggestions, key_prefix="act"):
     if not suggestions:
         return None
 
-    shown = suggestions[:4]
+    shown = tuple(suggestions[:4])
     cols = st.columns(len(shown))
-    for i, label in enumerate(shown):
-        if cols[i].button(label, key=f"{key_prefix}_{i}_{label}", use_container_width=True):
+    for col, label, key in zip(cols, shown, _chip_keys(key_prefix, shown)):
+        if col.button(label, key=key, use_container_width=True):
             return label
     return None
 
+# 재직증명서 트리거/이름 힌트 정제 패턴 (import 시 한 번만 컴파일)
+_EMPCERT_TRIGGER = re.compile(r"(재직\s*증명서|재직증명서|증명서\s*출력|employment\s*certificate)", re.IGNORECASE)
+_EMPCERT_STRIP = re.compile(r"(재직\s*증명서|재직증명서|증명서\s*출력|출력해|출력해줘|만들어줘|발급해|발급해줘)")
+
 def is_employment_cert_trigger(text: str) -> bool:
     """
     text 내용이 재직증명서 관련 요청인지 감지하는 함수.
     """
     t = (text or "").strip()
-    return bool(re.search(r"(재직\s*증명서|재직증명서|증명서\s*출력|employment\s*certificate)", t, re.IGNORECASE))
+    return bool(_EMPCERT_TRIGGER.search(t))
 
 def extract_employee_hint(text: str) -> str | None:
     """
@@ -303,26 +283,12 @@ def extract_employee_hint(text: str) -> str | None:
     재직증명서/출력/발급 등 키워드는 제거하여 남은 텍스트만 반환.
     """
     t = (text or "").strip()
-    t = re.sub(r"(재직\s*증명서|재직증명서|증명서\s*출력|출력해|출력해줘|만들어줘|발급해|발급해줘)", "", t)
+    t = _EMPCERT_STRIP.sub("", t)
     t = t.strip()
     return t if t else None
 
-def fetch_active_employees(name_hint: str | None = None, limit: int = 50) -> list[dict]:
-    """
-    현재 재직 중인 직원 리스트를 검색한다.
-    name_hint(이름/사번 일부)에 따라 LIKE 검색도 가능하다.
-    """
-    where = """
-    WHERE e.status = 'ACTIVE'
-      AND (e.end_date IS NULL OR e.end_date > CURRENT_DATE)
-    """
-    params = {"limit": limit}
-
-    if name_hint:
-        where += " AND (e.emp_name ILIKE :q OR e.emp_id::text ILIKE :q)"
-        params["q"] = f"%{name_hint}%"
-
-    sql = f"""
+# 재직자 검색 SQL (이름 힌트 유무 두 가지뿐 → 고정 템플릿으로 두고 값은 바인드 파라미터로만 전달)
+_SQL_ACTIVE_EMPLOYEES_BASE = """
     SELECT
       e.emp_id,
       e.emp_name,
@@ -333,24 +299,30 @@ def fetch_active_employees(name_hint: str | None = None, limit: int = 50) -> lis
     FROM employees e
     LEFT JOIN departments d
       ON d.dept_id = e.dept_id
-    {where}
+    WHERE e.status = 'ACTIVE'
+      AND (e.end_date IS NULL OR e.end_date > CURRENT_DATE)
+"""
+_SQL_ACTIVE_EMPLOYEES = _SQL_ACTIVE_EMPLOYEES_BASE + """
     ORDER BY e.emp_name
     LIMIT :limit;
-    """
-    return fetch_all(sql, params)
+"""
+_SQL_ACTIVE_EMPLOYEES_BY_HINT = _SQL_ACTIVE_EMPLOYEES_BASE + """
+      AND (e.emp_name ILIKE :q OR e.emp_id::text ILIKE :q)
+    ORDER BY e.emp_name
+    LIMIT :limit;
+"""
 
-# 한글 폰트(선택): 윈도우라면 보통 맑은 고딕 경로를 등록
-def ensure_korean_font():
+
+@st.cache_data(ttl=300, max_entries=128, show_spinner=False)
+def fetch_active_employees(name_hint: str | None = None, limit: int = 50) -> list[dict]:
     """
-    ReportLab에 한글 폰트(맑은 고딕)가 등록되지 않았으면 시스템 폰트 경로(윈도우 기준)에서 등록 시도.
+    현재 재직 중인 직원 리스트를 검색한다.
+    name_hint(이름/사번 일부)에 따라 LIKE 검색도 가능하다.
+    같은 검색어는 5분간 캐시 (직원 정보 변경 후에는 사이드바 '직원 목록 새로고침')
     """
-    try:
-        pdfmetrics.getFont("MalgunGothic")
-    except Exception:
-        # 윈도우 기본 폰트 경로 (환경에 따라 다를 수 있음)
-        font_path = r"C:\Windows\Fonts\malgun.ttf"
-        if os.path.exists(font_path):
-            pdfmetrics.registerFont(TTFont("MalgunGothic", font_path))
+    if name_hint:
+        return fetch_all(_SQL_ACTIVE_EMPLOYEES_BY_HINT, {"q": f"%{name_hint}%", "limit": limit})
+    return fetch_all(_SQL_ACTIVE_EMPLOYEES, {"limit": limit})
 
 # =====================================================
 # 📄 재직증명서 PDF 생성
@@ -359,6 +331,11 @@ def build_employment_certificate_pdf(emp: dict) -> bytes:
     """
     직원 dict 정보를 PDF 재직증명서로 생성해 bytes(다운로드/미리보기)로 반환하는 함수.
     """
+    # reportlab은 증명서를 실제로 만들 때만 로드 (콜드 스타트/메모리 절감)
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.pdfgen import canvas
+
     ensure_korean_font()  # 한글 폰트 등록 보장
 
     buffer = BytesIO()
@@ -412,48 +389,98 @@ def build_employment_certificate_pdf(emp: dict) -> bytes:
 FONT_PATH = "assets/fonts/NotoSansKR-Regular.ttf"
 FONT_NAME = "NotoSansKR"
 
+@st.cache_resource(show_spinner=False)
 def ensure_korean_font():
     """
     ReportLab에서 사용할 한글 폰트가 등록되어 있지 않으면, 지정 경로의 폰트를 등록한다.
+    - cache_resource로 감싸 프로세스당 한 번만 등록 (폰트 파일 파싱 반복 방지)
     """
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
     if FONT_NAME not in pdfmetrics.getRegisteredFontNames():
         if not os.path.exists(FONT_PATH):
             raise FileNotFoundError(f"Font not found: {FONT_PATH}")
         pdfmetrics.registerFont(TTFont(FONT_NAME, FONT_PATH))
 
 
-@st.cache_data(show_spinner=False)
+# 렌더된 PNG 최대 보관 개수 (프로세스 공용 LRU)
+PDF_PNG_CACHE_MAX = 64
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _get_fitz_doc(pdf_sha1: str, _pdf_bytes: bytes):
+    """
+    sha1 단위로 fitz.Document를 한 번만 열어 재사용 (페이지/확대 변경마다 PDF 재파싱 방지)
+    - 바이트는 _ 인자로 받아 캐시 키 해싱에서 제외 (sha1이 키)
+    """
+    import fitz  # PyMuPDF: 미리보기를 열 때만 로드
+
+    return fitz.open(stream=_pdf_bytes, filetype="pdf")
+
+
+@st.cache_resource(show_spinner=False)
+def _pdf_render_state() -> dict:
+    """
+    (sha1, 페이지, 확대) → PNG 바이트 LRU와 렌더 락
+    - cache_data와 달리 적중 시 pickle 복사 없이 같은 bytes 객체를 그대로 반환
+    - fitz.Document는 스레드 안전하지 않으므로 렌더는 락 안에서 수행
+    """
+    return {"pngs": OrderedDict(), "lock": threading.Lock()}
+
+
 def _render_pdf_page_png(pdf_sha1: str, pdf_bytes: bytes, page_idx: int, zoom: float) -> bytes:
     """
     PDF 바이트와 페이지 인덱스를 받아 PNG 바이트로 렌더링
-    - 동일 pdf/페이지/확대비율이면 바로 캐시 사용
+    - 동일 pdf/페이지/확대비율(0.05 단위)이면 바로 캐시 사용
     """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    try:
-        page = doc.load_page(int(page_idx))
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        return pix.tobytes("png")
-    finally:
-        doc.close()
+    import fitz
+
+    key = (pdf_sha1, int(page_idx), round(zoom * 20) / 20)
+    state = _pdf_render_state()
+    pngs = state["pngs"]
 
-def pdf_preview(pdf_bytes: bytes, default_zoom: float = 1.4):
+    with state["lock"]:
+        png = pngs.get(key)
+        if png is not None:
+            pngs.move_to_end(key)
+            return png
+
+        page = _get_fitz_doc(pdf_sha1, pdf_bytes).load_page(key[1])
+        mat = fitz.Matrix(key[2], key[2])
+        png = page.get_pixmap(matrix=mat, alpha=False).tobytes("png")
+
+        pngs[key] = png
+        while len(pngs) > PDF_PNG_CACHE_MAX:
+            pngs.popitem(last=False)
+        return png
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _load_pdf_file(path: str, mtime_ns: int, size: int) -> tuple[bytes, str]:
+    """
+    (경로, 수정시각, 크기) 단위로 PDF 바이트와 sha1을 한 번만 읽고 계산해 재사용.
+    위젯 조작마다 재실행되어도 파일 읽기/해시 없이 stat 한 번으로 끝남 (파일이 바뀌면 키가 바뀜)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return data, hashlib.sha1(data).hexdigest()
+
+
+def pdf_preview(pdf_bytes: bytes, default_zoom: float = 1.4, pdf_sha1: str | None = None):
     """
     Streamlit에서 PDF를 이미지로 미리보기 렌더링하는 함수.
     페이지 전환, 확대, 폭맞춤 토글 등 ui 컨트롤 포함
+    pdf_sha1을 이미 알고 있으면 넘겨서 재해시를 생략
     """
     if not pdf_bytes:
         return
 
-    # 캐시 키로 쓸 sha1 해시값 계산
-    pdf_sha1 = hashlib.sha1(pdf_bytes).hexdigest()
+    # 캐시 키로 쓸 sha1 해시값 계산 (호출 측에서 받지 못한 경우만)
+    if pdf_sha1 is None:
+        pdf_sha1 = hashlib.sha1(pdf_bytes).hexdigest()
 
-    # 페이지 수는 한번만 체크(캐시 이외)
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    try:
-        page_count = doc.page_count
-    finally:
-        doc.close()
+    # 페이지 수는 캐시된 문서 핸들에서 바로 조회
+    page_count = _get_fitz_doc(pdf_sha1, pdf_bytes).page_count
 
     ctrl_col, view_col = st.columns([1, 5], vertical_alignment="top")
 
@@ -469,14 +496,14 @@ def pdf_preview(pdf_bytes: bytes, default_zoom: float = 1.4):
         fit_to_width = st.toggle("화면에 맞춤", value=True)
 
     # PDF -> 이미지 렌더
+    # st.image가 PNG 바이트를 직접 받으므로 PIL 디코딩 없이 그대로 전달
     png_bytes = _render_pdf_page_png(pdf_sha1, pdf_bytes, int(page_idx), float(zoom))
-    img = Image.open(BytesIO(png_bytes))
 
     with view_col:
         if fit_to_width:
-            st.image(img, use_container_width=True)
+            st.image(png_bytes, use_container_width=True)
         else:
-            st.image(img, use_container_width=False)
+            st.image(png_bytes, use_container_width=False)
 
 
 def build_reasoning_trace(question: str, intent: str, decision_type: str | None):
@@ -540,106 +567,148 @@ if "scenario_memory" not in st.session_state:
 # =====================================================
 # CSS (상단 공백 제거)
 # =====================================================
-st.markdown(
-    """
-    <style>
-    .block-container {
-        padding-top: 0.55rem !important;
-        padding-bottom: 1rem;
-    }
-    @media (max-width: 768px) {
-        .block-container { padding-top: 0.35rem !important; }
-    }
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+CSS_PATH = "assets/css/app_hr_sql.css"
 
-# ===============================
-# 2) 환경변수 로드
-# ===============================
-def get_google_api_key() -> str | None:
+
+@st.cache_resource(show_spinner=False)
+def load_css(path: str) -> str:
     """
-    환경변수에서 GOOGLE_API_KEY 값을 읽어온다.
+    정적 CSS 파일을 한 번만 읽어 <style> 블록 문자열로 캐시한다.
     """
-    return os.getenv("GOOGLE_API_KEY")
+    with open(path, encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
 
 
-def get_db_uri() -> str | None:
-    """
-    환경변수에서 SUPABASE_DB_URI 값을 읽어온다.
-    """
-    return os.getenv("SUPABASE_DB_URI")
+st.markdown(load_css(CSS_PATH), unsafe_allow_html=True)
 
-api_key = get_google_api_key()
-db_uri = get_db_uri()
+# ===============================
+# 2) 환경변수 로드
+# ===============================
+# 프로세스 수명 동안 바뀌지 않는 값이므로 import 시 한 번만 읽어 상수로 둔다
+API_KEY = os.environ.get("GOOGLE_API_KEY")
+DB_URI = os.environ.get("SUPABASE_DB_URI")
 
 # ===============================
 # 3) 환경변수 검증
 # ===============================
-# LLM API KEY, DB URI 미설정 시 안내 후 앱 중단
-if not api_key:
-    st.error("❌ GOOGLE_API_KEY가 설정되어 있지 않습니다. (Render: Environment Variables 확인)")
-    st.stop()
+@st.cache_resource(show_spinner=False)
+def _validate_env() -> tuple:
+    """
+    LLM API KEY, DB URI 설정 오류를 한 번에 모아 반환 (값이 상수라 프로세스당 1회만 검사).
+    """
+    errs = []
+    if not API_KEY:
+        errs.append("❌ GOOGLE_API_KEY가 설정되어 있지 않습니다. (Render: Environment Variables 확인)")
+    if not DB_URI:
+        errs.append("❌ SUPABASE_DB_URI이 설정되어 있지 않습니다. (Render: Environment Variables 확인)")
+    elif "YOUR-PASSWORD" in DB_URI:
+        errs.append("❌ SUPABASE_DB_URI에 [YOUR-PASSWORD]가 그대로 있습니다.")
+    return tuple(errs)
 
-if not db_uri:
-    st.error("❌ SUPABASE_DB_URI이 설정되어 있지 않습니다. (Render: Environment Variables 확인)")
-    st.stop()
 
-if "YOUR-PASSWORD" in db_uri:
-    st.error("❌ SUPABASE_DB_URI에 [YOUR-PASSWORD]가 그대로 있습니다.")
+# 미설정 항목을 모두 안내한 뒤 앱 중단
+env_errors = _validate_env()
+if env_errors:
+    for err in env_errors:
+        st.error(err)
     st.stop()
 
 
 # =====================================================
 # 3) HR/LLM 엔진 + Explainer
 # =====================================================
-@st.cache_resource(show_spinner=False)
+# LangChain/Gemini 계열 import는 무거우므로 환경변수 검증을 통과한 뒤에만 로드
+from HR_sql_ai import HRTextToSQLEngine, ENGINE_VERSION, get_llm, load_schema, truncate_result
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_schema(db_uri: str, version: str) -> str:
+    """
+    DB 스키마(샘플 행 제외, 압축)를 DB URI/엔진 버전 단위로 캐시해서 반환.
+    """
+    return load_schema(db_uri, version)
+
+
+@st.cache_resource(show_spinner=False, ttl=3600)
 def get_hr_engine(_db_uri: str, _api_key: str, _version: str) -> HRTextToSQLEngine:
     """
-    HRTextToSQLEngine (LLM SQL 생성+실행 엔진)를 환경값에 맞춰 한 번만 생성 (캐시).
+    HRTextToSQLEngine (LLM SQL 생성+실행 엔진)를 환경값에 맞춰 생성 (캐시, 1시간마다 재생성).
+    exec_sql과 같은 get_db_engine() 커넥션 풀을 공유 → 프로세스당 DB 풀은 하나.
+    """
+    return HRTextToSQLEngine(
+        db_uri=_db_uri,
+        api_key=_api_key,
+        schema=get_schema(_db_uri, _version),
+        engine=get_db_engine(),
+    )
+
+
+# 헬스체크(SELECT 1) 최소 간격: 매 질문마다 왕복하지 않도록 제한
+HR_ENGINE_CHECK_SEC = 60
+
+
+@st.cache_resource(show_spinner=False)
+def _hr_engine_health() -> dict:
+    """
+    마지막 헬스체크 시각 (프로세스 공용, rerun에도 유지)
     """
-    return HRTextToSQLEngine(db_uri=_db_uri, api_key=_api_key)
+    return {"checked_at": 0.0}
 
 
 def ensure_hr_engine() -> HRTextToSQLEngine:
     """
     HRTextToSQLEngine 인스턴스를 캐시에서 불러오기. 필요시만 호출.
+    유휴 타임아웃 등으로 DB 연결이 죽었으면 캐시를 비우고 새 엔진으로 교체한다.
     """
-    return get_hr_engine(db_uri, api_key, ENGINE_VERSION)
+    hr = get_hr_engine(DB_URI, API_KEY, ENGINE_VERSION)
+
+    health = _hr_engine_health()
+    now = time.monotonic()
+    if now - health["checked_at"] < HR_ENGINE_CHECK_SEC:
+        return hr
+
+    try:
+        # hr.execute는 DB 오류를 "Error: ..." 문자열로 돌려주므로 예외가 그대로 올라오는 db.run으로 확인
+        hr.db.run("SELECT 1")
+    except Exception:
+        # 공유 풀의 죽은 커넥션을 비우고 엔진 재생성
+        get_db_engine().dispose()
+        get_hr_engine.clear()
+        hr = get_hr_engine(DB_URI, API_KEY, ENGINE_VERSION)
+    health["checked_at"] = now
+    return hr
 
 @st.cache_resource(show_spinner=False)
 def get_explainer(_api_key: str):
     """
     SQL 실행결과를 한글로 명확히 해설/요약해주는 Gemini 기반 체인 반환.
     """
-    prompt = ChatPromptTemplate.from_template(
-        """당신은 '넝쿨 HR 데이터 에이전트'입니다. 제공된 SQL 결과 데이터를 바탕으로 사용자에게 전문적이고 통찰력 있는 보고를 수행하세요.
-
-        [답변 가이드라인]
-        1. **결론 중심**: 데이터 조회 결과를 한 줄로 요약하며 시작하세요.
-        2. **가독성**: 숫자나 리스트는 마크다운 표나 불렛 포인트를 활용해 한눈에 들어오게 하세요.
-        3. **인사이트**: 데이터에서 읽을 수 있는 비즈니스적 의미(예: 전월 대비 변화, 특정 부서 집중 현상 등)를 짧게 언급하세요.
-        4. **제언**: 분석 결과를 바탕으로 사용자가 다음에 확인해야 할 질문이나 액션을 제안하세요.
-        5. **데이터 부재**: 결과가 없는 경우, 단순히 없다고 하기보다 '현재 조건으로는 데이터를 찾을 수 없으니, 기간이나 대상을 변경해보시는 것은 어떨까요?'와 같이 유연하게 대응하세요.
-
-        질문: {question}
-        SQL 결과: {result}
-
-        데이터 에이전트의 답변:"""
-    )
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+
+    # 고정 지침은 system, 매 턴 바뀌는 값은 human 메시지 끝에 둠
+    #   → 요청 앞부분(prefix)이 매번 동일해 Gemini 프롬프트 캐시(implicit caching) 적중 대상이 됨
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", """당신은 '넝쿨 HR 데이터 에이전트'입니다. 제공된 SQL 결과 데이터를 바탕으로 사용자에게 전문적이고 통찰력 있는 보고를 수행하세요.
+
+[답변 가이드라인]
+1. **결론 중심**: 데이터 조회 결과를 한 줄로 요약하며 시작하세요.
+2. **가독성**: 숫자나 리스트는 마크다운 표나 불렛 포인트를 활용해 한눈에 들어오게 하세요.
+3. **인사이트**: 데이터에서 읽을 수 있는 비즈니스적 의미(예: 전월 대비 변화, 특정 부서 집중 현상 등)를 짧게 언급하세요.
+4. **제언**: 분석 결과를 바탕으로 사용자가 다음에 확인해야 할 질문이나 액션을 제안하세요.
+5. **데이터 부재**: 결과가 없는 경우, 단순히 없다고 하기보다 '현재 조건으로는 데이터를 찾을 수 없으니, 기간이나 대상을 변경해보시는 것은 어떨까요?'와 같이 유연하게 대응하세요."""),
+        ("human", """질문: {question}
+SQL 결과: {result}
+
+데이터 에이전트의 답변:"""),
+    ])
     return (
         prompt
-        | ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            google_api_key=_api_key,
-            temperature=0.2
-        )
+        | get_llm(_api_key, temperature=0.2)
         | StrOutputParser()
     )
 
 
-explainer = get_explainer(api_key)
+explainer = get_explainer(API_KEY)
 
 # ... (기존 get_explainer 함수 아래에 추가) ...
 
@@ -648,35 +717,58 @@ def get_rewriter(_api_key: str):
     """
     사용자의 불완전한 질문을 대화 히스토리를 참고해 '완전한 독립문장'으로 재작성(프롬프트)해주는 체인 반환.
     """
-    prompt = ChatPromptTemplate.from_template(
-        """당신은 사용자의 질문을 데이터베이스 조회를 위한 '완전한 질문'으로 재구성하는 AI입니다.
-        
-        [대화 기록]
-        {history}
-        
-        [현재 질문]
-        {question}
-        
-        위 대화 흐름을 고려하여, [현재 질문]을 SQL 생성이 가능한 '구체적이고 독립적인 질문'으로 다시 작성하세요.
-        - 대명사("그것", "이전 것")가 있다면 명확한 명사로 바꾸세요.
-        - 조건("반대로", "True만")이 변경되었다면 전체 문장에 반영하세요.
-        - 질문의 의도가 바뀌지 않도록 주의하세요.
-        - 설명 없이 오직 '재작성된 질문'만 출력하세요.
-        
-        재작성된 질문:"""
-    )
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+
+    # 고정 지침을 system(앞), 대화 기록/현재 질문을 human(뒤)으로 분리 → 요청 prefix가 매 턴 동일
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", """당신은 사용자의 질문을 데이터베이스 조회를 위한 '완전한 질문'으로 재구성하는 AI입니다.
+
+주어진 [대화 기록]의 흐름을 고려하여, [현재 질문]을 SQL 생성이 가능한 '구체적이고 독립적인 질문'으로 다시 작성하세요.
+- 대명사("그것", "이전 것")가 있다면 명확한 명사로 바꾸세요.
+- 조건("반대로", "True만")이 변경되었다면 전체 문장에 반영하세요.
+- 질문의 의도가 바뀌지 않도록 주의하세요.
+- 설명 없이 오직 '재작성된 질문'만 출력하세요."""),
+        ("human", """[대화 기록]
+{history}
+
+[현재 질문]
+{question}
+
+재작성된 질문:"""),
+    ])
     return (
         prompt
-        | ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash", 
-            google_api_key=_api_key, 
-            temperature=0.1
-        )
+        | get_llm(_api_key, temperature=0.1)
         | StrOutputParser()
     )
 
+
+# 이전 대화를 가리키는 지시어/접속 표현 (있으면 재작성 필요)
+#   - '그', '이' 같은 한 글자는 '이번 달' 등 일반 질문에도 들어가므로 제외
+_REWRITE_HINT = re.compile(
+    r"(그거|저거|이거|그것|저것|이것|그\s*중|그\s*사람|그\s*팀|그\s*부서|그\s*때|거기"
+    r"|아까|이전|방금|앞에서|위에서|위\s*결과|반대로|나머지|대신|말고|다시"
+    r"|^\s*(그럼|그러면|그리고|그래서|또))"
+)
+# 공백 제외 이 길이 이하의 짧은 질문('2월은?', '부서별로는?')은 생략된 맥락이 있다고 보고 재작성
+REWRITE_SHORT_LEN = 8
+
+
+def needs_rewrite(question: str) -> bool:
+    """
+    질문이 이전 대화에 기대는지(지시어/접속 표현, 지나치게 짧은 후속 질문) 판단.
+    False면 이미 독립적인 질문으로 보고 재작성기 LLM 호출을 생략한다.
+    """
+    q = question or ""
+    return len("".join(q.split())) <= REWRITE_SHORT_LEN or bool(_REWRITE_HINT.search(q))
+
+
 @st.cache_resource(show_spinner=False)
 def get_decision_classifier(_api_key: str):
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+
     prompt = ChatPromptTemplate.from_template(
         """
 You are an HR Decision Type Classifier.
@@ -739,15 +831,45 @@ Input: {question}
 
     return (
         prompt
-        | ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            google_api_key=_api_key,
-            temperature=0.0
-        )
+        | get_llm(_api_key, temperature=0.0)
         | StrOutputParser()
     )
 
 
+@st.cache_resource(ttl=300, show_spinner=False)
+def get_response_cache(version: str) -> dict:
+    """
+    (체인, 입력) → 응답 텍스트 캐시. 새로고침/재시도/대표 질문 반복 시
+    디스크 LLM 캐시 조회와 프롬프트 렌더링까지 건너뛴다. (ENGINE_VERSION 단위로 분리)
+    """
+    return {}
+
+
+def _question_key(question: str) -> str:
+    """
+    질문 캐시 키: 공백·끝 문장부호·영문 대소문자 차이를 무시 ('부서별 인원수는?' == '부서별인원수는')
+    (본문 안의 '.'/','는 1.5 vs 15처럼 의미가 달라질 수 있어 그대로 둠)
+    """
+    return "".join(question.split()).rstrip("?？!.~").lower()
+
+
+def stream_explanation(question: str, result_text: str) -> str:
+    """
+    단건 설명을 토큰 단위로 스트리밍해 현재 위치에 바로 표시하고 최종 문자열을 반환.
+    (전체 응답을 기다리지 않아 첫 글자가 곧바로 보임)
+    (질문, 결과 텍스트) 캐시 키로 응답 캐시에 저장해 적중 시 LLM 호출 없이 캐시된 텍스트를 표시·반환.
+    """
+    cache = get_response_cache(ENGINE_VERSION)
+    key = ("explain", question, result_text)
+    answer = cache.get(key)
+    if answer is None:
+        answer = st.write_stream(explainer.stream({"question": question, "result": result_text}))
+        cache[key] = answer
+    else:
+        st.markdown(answer)
+    return answer
+
+
 DECISION_ACTION_TEMPLATES = {
     "STAFFING": [
         "현재 인원 현황 보여줘",
@@ -786,75 +908,125 @@ DECISION_ACTION_TEMPLATES = {
     ]
 }
 
-def format_history(messages, limit=6):
+# 재작성기 프롬프트에 넣는 대화 이력 상한 (프롬프트 토큰 → TTFT 상한)
+MAX_HISTORY_MESSAGES = 6          # 최근 3턴
+HISTORY_MSG_MAX_CHARS = 600       # 메시지 1개당 최대 글자수 (긴 표/보고서 답변 절단)
+_HISTORY_ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+
+
+def _history_line(msg: dict) -> str:
+    """메시지 1개를 재작성기 프롬프트용 이력 한 줄로 변환 (max_chars 초과분은 절단)"""
+    content = msg["content"] or ""
+    if len(content) > HISTORY_MSG_MAX_CHARS:
+        content = content[:HISTORY_MSG_MAX_CHARS] + "…"
+    return f"{_HISTORY_ROLE_LABELS.get(msg['role'], 'Assistant')}: {content}\n"
+
+
+def _history_lines() -> deque:
+    """
+    최근 MAX_HISTORY_MESSAGES개 이력 줄을 담는 세션별 deque.
+    messages는 append만 되므로 추가 시점에 한 줄씩 밀어 넣고, 오래된 줄은 maxlen으로 자동 제거.
+    (세션에 없으면 기존 messages 꼬리로 한 번만 채움)
+    """
+    lines = st.session_state.get("history_lines")
+    if lines is None:
+        lines = deque(
+            (_history_line(m) for m in st.session_state.messages[-MAX_HISTORY_MESSAGES:]),
+            maxlen=MAX_HISTORY_MESSAGES,
+        )
+        st.session_state.history_lines = lines
+    return lines
+
+
+def append_message(msg: dict) -> None:
     """
-    세션에 저장된 메시지 중 최근 N개를 user/assistant 구분과 함께 텍스트로 변환(이상형 대화 이력 string).
-    너무 오래된 것은 잘라내고 최근 limit개 정도만 반환한다.
+    messages에 메시지를 추가하면서 이력 줄도 함께 갱신 (format_history가 messages를 다시 훑지 않도록)
     """
-    history_text = ""
-    # 너무 오래된 기억은 버리고 최근 3턴(6개) 정도만 참조
-    recent_msgs = messages[-limit:] if len(messages) > limit else messages
+    st.session_state.messages.append(msg)
+    _history_lines().append(_history_line(msg))
 
-    for msg in recent_msgs:
-        role = "User" if msg["role"] == "user" else "Assistant"
-        content = msg["content"]
-        history_text += f"{role}: {content}\n"
 
-    return history_text
+def format_history() -> str:
+    """
+    최근 3턴(6개) 대화 이력을 user/assistant 구분과 함께 텍스트로 반환(이상형 대화 이력 string).
+    줄은 append_message 시점에 미리 만들어 두므로 여기서는 결합만 한다.
+    """
+    return "".join(_history_lines())
+
 
 # =====================================================
 # 4) (RPC 전용) 결과 파서 / SQL 실행 유틸
 # =====================================================
 def _to_rows(result):
     """
-    Gemini/QuerySQLDatabaseTool 등에서 SQL 결과가 list/tuple, 문자열등 여러 형태로 들어오므로 
-    일관적으로 list 결과(딕셔너리 or 튜플)로 변환해서 반환.
+    exec_sql 결과를 행(튜플) 리스트로 정규화.
+    exec_sql이 드라이버 행을 그대로 돌려주므로 문자열 재파싱은 하지 않고,
+    문자열(실행 오류 메시지 등)이나 None은 빈 결과로 취급한다.
     """
-    if result is None:
-        return []
-
     if isinstance(result, (list, tuple)):
         return list(result)
+    return []
 
-    if isinstance(result, str):
-        s = result.strip()
-        # Decimal, UUID 등 문자열을 파이썬 기본타입으로 치환하여 파싱
-        s = re.sub(r"Decimal\('(-?\d+(?:\.\d+)?)'\)", r"\1", s)
-        s = re.sub(r'Decimal\("(-?\d+(?:\.\d+)?)"\)', r"\1", s)
-        s = re.sub(r"UUID\('([0-9a-fA-F-]+)'\)", r"'\1'", s)
-        s = s.replace("NULL", "None")
 
-        try:
-            v = ast.literal_eval(s)
-            if isinstance(v, (list, tuple)):
-                return list(v)
-            return [v]
-        except Exception:
-            return []
+def exec_sql(sql: str, params: dict | None = None):
+    """
+    공용 SQLAlchemy 엔진(커넥션 풀)으로 SQL을 실행하고 결과를 튜플 리스트로 반환.
+    드라이버 행을 그대로 튜플로 돌려주므로 호출 측에서 문자열을 재파싱할 필요가 없다.
+    RPC 함수 호출도 포함되므로 트랜잭션(begin)으로 실행해 커밋한다.
+    params가 있으면 :name 바인드 파라미터로 전달 (값을 SQL 문자열에 끼워 넣지 않음).
+    실패 시에는 예외 대신 "Error: ..." 문자열을 반환 (HRTextToSQLEngine.execute와 같은 규약).
+    """
+    try:
+        with get_db_engine().begin() as conn:
+            result = conn.execute(_prep(sql), params or {})
+            if not result.returns_rows:
+                return []
+            return [tuple(r) for r in result]
+    except SQLAlchemyError as e:
+        return f"Error: {e}"
 
-    return []
+
+def exec_sql_chain(sql: str, params: dict, follow_sql: str, follow_key: str, whole_row: bool = False):
+    """
+    sql 결과 첫 행의 첫 값(예: RPC가 돌려준 run_id)을 follow_sql의 :follow_key로 넘겨
+    같은 커넥션·트랜잭션에서 연달아 실행 (풀 체크아웃/커밋 왕복을 한 번으로 줄임).
+    같은 트랜잭션이므로 follow_sql은 앞 RPC가 쓴 행을 그대로 볼 수 있다.
+    whole_row=True면 첫 행 전체를 문자열 리스트로 넘김 (여러 run_id를 any(...)로 한 번에 조회)
+    반환: (첫 결과, 후속 결과) — 첫 결과가 비었거나(whole_row면 None 포함) 실패하면 후속 결과는 []
+    """
+    try:
+        with get_db_engine().begin() as conn:
+            first = [tuple(r) for r in conn.execute(_prep(sql), params or {})]
+            head = first[0] if first else ()
+            if not head or (None in head if whole_row else head[0] is None):
+                return first, []
+            value = [str(v) for v in head] if whole_row else str(head[0])
+            follow = conn.execute(_prep(follow_sql), {follow_key: value})
+            return first, [tuple(r) for r in follow]
+    except SQLAlchemyError as e:
+        return f"Error: {e}", []
 
 
-def exec_sql(sql: str):
+def sql_for_display(sql: str, params: dict) -> str:
     """
-    HRTextToSQLEngine의 executor를 활용해(캐시엔진 활용) SQL을 실행하고 결과 반환.
+    화면(실행된 SQL expander) 표시용: 바인드 SQL 아래에 파라미터 값을 주석으로 덧붙임
     """
-    hr = ensure_hr_engine()
-    return hr.executor.invoke({"query": sql})
+    return f"{sql.strip()}\n-- params: {params}"
 
 
-def classify_decision(question: str) -> dict:
-    classifier = get_decision_classifier(api_key)
+# 분류기 응답 앞뒤 markdown fence (```json ... ```) → 한 번의 sub로 제거
+_JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
 
-    raw = classifier.invoke({"question": question})
 
+def _parse_decision(raw: str) -> dict:
+    """
+    분류기 원문(JSON 문자열)을 dict로 파싱. 실패 시 DATA_QUERY로 간주.
+    """
     # markdown fence 제거
-    raw = raw.strip()
-    if raw.startswith("```"):
-        raw = raw.replace("```json", "").replace("```", "").strip()
+    raw = _JSON_FENCE.sub("", raw.strip())
 
     try:
-        return json.loads(raw)
+        return orjson.loads(raw)
     except Exception as e:
         return {
             "intent": "DATA_QUERY",
@@ -864,12 +1036,56 @@ def classify_decision(question: str) -> dict:
         }
 
 
+async def _aclassify_and_rewrite(question: str, history_str: str | None):
+    """
+    의사결정 분류와 질문 재작성은 서로 독립적인 LLM 호출이므로 동시에 실행한다.
+    history_str이 None이면 재작성 없이 분류만 수행 → (decision, None)
+    분류(질문 단위)·재작성(히스토리+질문 단위) 중 캐시에 있는 쪽은 호출하지 않는다.
+    """
+    cache = get_response_cache(ENGINE_VERSION)
+    classify_key = ("classify", question)
+    rewrite_key = ("rewrite", history_str, question)
+
+    decision = cache.get(classify_key)
+    rewritten = None if history_str is None else cache.get(rewrite_key)
+
+    calls = {}
+    if decision is None:
+        calls["classify"] = get_decision_classifier(API_KEY).ainvoke({"question": question})
+    if history_str is not None and rewritten is None:
+        calls["rewrite"] = get_rewriter(API_KEY).ainvoke({"history": history_str, "question": question})
+
+    if calls:
+        results = dict(zip(calls, await asyncio.gather(*calls.values())))
+        if "classify" in results:
+            decision = _parse_decision(results["classify"])
+            # 파싱 실패(DATA_QUERY 폴백)는 캐시하지 않고 다음 턴에 다시 분류
+            if "error" not in decision:
+                cache[classify_key] = decision
+        if "rewrite" in results:
+            rewritten = cache[rewrite_key] = results["rewrite"]
+
+    return decision, rewritten
+
+
+def classify_and_rewrite(question: str, history_str: str | None):
+    """
+    분류(+필요 시 재작성)를 한 번의 이벤트 루프에서 병렬 실행하는 동기 래퍼.
+    """
+    return asyncio.run(_aclassify_and_rewrite(question, history_str))
+
+
 def fmt_won(n):
     """
     숫자를 세 자리 콤마와 '원' 단위로 출력 (에러시 그대로 리턴)
     예: 1000000 -> 1,000,000원
     """
+    # 대부분 이미 정수로 들어오므로 변환/예외 처리 없이 바로 포맷
+    if isinstance(n, int):
+        return f"{n:,}원"
     try:
+        if isinstance(n, float):
+            return f"{int(n):,}원"
         return f"{int(float(n)):,}원"
     except Exception:
         return str(n)
@@ -878,112 +1094,195 @@ def fmt_won(n):
 # =====================================================
 # 5) RPC 급여 시나리오: 슬롯 추출 (간단)
 # =====================================================
+# extract_* 는 입력 문자열만으로 결과가 정해지는 순수 함수(TODAY_* 는 상수)
+#   → 같은 메시지를 재평가하는 rerun에서는 lru_cache로 바로 반환
 TODAY_Y = 2026
 TODAY_M = 1
 
+# 매 메시지(rerun)마다 호출되므로 패턴은 모듈 로드 시 한 번만 컴파일
+_PERIOD_YMD = re.compile(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])\b")
+_PERIOD_KR = re.compile(r"\b(20\d{2})\s*년\s*(0?[1-9]|1[0-2])\s*월\b")
+_MONTH_ONLY = re.compile(r"\b(0?[1-9]|1[0-2])\s*월\b")
+_THIS_MONTH = re.compile(r"(이번\s*달|당월|이번달)")
+
+_SCOPE_ALL = re.compile(r"(전\s*직원|전체\s*직원|전체|전사|모두|전부서|전\s*부서|전부\s*서)")
+_SCOPE_DEPT = re.compile(r"\b([가-힣A-Za-z0-9_]+)\s*(부|팀)\b")
+
+_DATE_YMD = re.compile(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])[-./](0?[1-9]|[12]\d|3[01])\b")
+_DATE_MD = re.compile(r"\b(0?[1-9]|1[0-2])\s*/\s*(0?[1-9]|[12]\d|3[01])\b")
+_DATE_DAY = re.compile(r"\b(0?[1-9]|[12]\d|3[01])\s*일\b")
+
+# 기간/날짜 슬롯 후보 여부 (위 패턴은 모두 숫자 또는 '이번 달/당월'이 있어야 매칭됨)
+_SLOT_HINT = re.compile(r"\d|달|당월")
+
+# 확인 응답은 고정 단어 전체 일치 → 소문자 정규화 후 집합 조회 (IGNORECASE fullmatch와 동일)
+_CONFIRM_YES = frozenset(("예", "네", "응", "진행", "실행", "확정", "ok", "ㅇㅋ"))
+_CONFIRM_NO = frozenset(("아니오", "아니", "취소", "중단", "no", "ㄴㄴ"))
+
+# RPC 키워드(고정 문자열) → 통합 스캔 전에 부분 문자열 검사로 먼저 걸러냄
+_RPC_KEYWORDS = ("급여", "세금", "공제", "지급", "이체", "송금", "전표", "분개")
 
+# RPC/실행/조회 키워드를 한 번의 스캔으로 분류하는 통합 패턴
+#   - 전방탐색(?=)으로 글자를 소비하지 않아 '상세금액'의 '세금'처럼 겹친 키워드도 놓치지 않음
+#   - '전표생성', '지급해'는 RPC 키워드를 포함하므로 exec 그룹에 먼저 두고 RPC로도 인정
+_INTENT_RE = re.compile(
+    r"(?=(?P<exec>전표생성|지급해|처리|실행|진행|계산|산정해|돌려|생성해|등록)"
+    r"|(?P<rpc>급여|세금|공제|지급|이체|송금|전표|분개)"
+    r"|(?P<query>몇\s*명|인원|대상|총액|합계|금액|건수|결과|내역|리스트|상세|조회|보여줘))"
+)
+_EXEC_RPC_COMPOUNDS = frozenset(("전표생성", "지급해"))
+
+
+def _has_digit(t: str) -> bool:
+    """
+    한 번의 선형 스캔으로 숫자 포함 여부 확인 (대부분의 후속 질문엔 숫자가 없음)
+    """
+    return any(c.isdigit() for c in t)
+
+
+@lru_cache(maxsize=256)
 def extract_period(text: str):
     """
     질문에서 2026-01, 2026년 1월 등 '년-월' 기간을 추출
     """
     t = text.strip()
 
-    m = re.search(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])\b", t)
-    if m:
-        return f"{m.group(1)}-{int(m.group(2)):02d}"
+    # 숫자가 하나도 없으면 숫자 기반 패턴 3개는 스캔할 필요가 없음
+    if _has_digit(t):
+        m = _PERIOD_YMD.search(t)
+        if m:
+            return f"{m.group(1)}-{int(m.group(2)):02d}"
 
-    m = re.search(r"\b(20\d{2})\s*년\s*(0?[1-9]|1[0-2])\s*월\b", t)
-    if m:
-        return f"{m.group(1)}-{int(m.group(2)):02d}"
+        m = _PERIOD_KR.search(t)
+        if m:
+            return f"{m.group(1)}-{int(m.group(2)):02d}"
 
-    m = re.search(r"\b(0?[1-9]|1[0-2])\s*월\b", t)
-    if m:
-        return f"{TODAY_Y}-{int(m.group(1)):02d}"
+        m = _MONTH_ONLY.search(t)
+        if m:
+            return f"{TODAY_Y}-{int(m.group(1)):02d}"
 
-    if re.search(r"(이번\s*달|당월|이번달)", t):
+    if _THIS_MONTH.search(t):
         return f"{TODAY_Y}-{TODAY_M:02d}"
 
     return None
 
 
+@lru_cache(maxsize=256)
 def extract_scope(text: str):
     """
     질문 텍스트에서 '전체/전직원/부서 등' 범위(scope) 지정 키워드 추출
     """
     t = text.strip()
 
-    if re.search(r"(전\s*직원|전체\s*직원|전체|전사|모두|전부서|전\s*부서|전부\s*서)", t):
+    if _SCOPE_ALL.search(t):
         return "ALL"
 
-    m = re.search(r"\b([가-힣A-Za-z0-9_]+)\s*(부|팀)\b", t)
+    m = _SCOPE_DEPT.search(t)
     if m:
         return f"dept:{m.group(1)}{m.group(2)}"
 
     return None
 
 
+@lru_cache(maxsize=256)
 def extract_date_any(text: str):
     """
     yyyy-mm-dd, m/d, 일 등 날짜 관련 정보 패턴을 찾아 date string으로 반환(년은 period로 유추)
     """
     t = text.strip()
+    if not _has_digit(t):
+        return None
 
-    m = re.search(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])[-./](0?[1-9]|[12]\d|3[01])\b", t)
+    m = _DATE_YMD.search(t)
     if m:
         return f"{int(m.group(1)):04d}-{int(m.group(2)):02d}-{int(m.group(3)):02d}"
 
-    m = re.search(r"\b(0?[1-9]|1[0-2])\s*/\s*(0?[1-9]|[12]\d|3[01])\b", t)
+    m = _DATE_MD.search(t)
     if m:
         return f"__MD__:{int(m.group(1))}:{int(m.group(2))}"
 
-    m = re.search(r"\b(0?[1-9]|[12]\d|3[01])\s*일\b", t)
+    m = _DATE_DAY.search(t)
     if m:
         return f"__DAY__:{int(m.group(1))}"
 
     return None
 
 
+def scan_slots(text: str) -> dict:
+    """
+    한 턴의 사용자 입력에서 기간/범위/날짜 슬롯을 한 번에 추출.
+    숫자가 없는 입력은 숫자 패턴 스캔을 통째로 건너뛴다.
+    """
+    return {
+        "period": extract_period(text),
+        "scope": extract_scope(text),
+        "date": extract_date_any(text),
+    }
+
+
+@lru_cache(maxsize=256)
 def extract_confirm(text: str):
     """
     예/아니오/확정/취소 등 사용자의 확인(확정의도) 값을 True/False/None으로 해석
     """
-    t = text.strip()
-    if re.fullmatch(r"(예|네|응|진행|실행|확정|ok|ㅇㅋ)", t, flags=re.IGNORECASE):
+    t = text.strip().lower()
+    if t in _CONFIRM_YES:
         return True
-    if re.fullmatch(r"(아니오|아니|취소|중단|no|ㄴㄴ)", t, flags=re.IGNORECASE):
+    if t in _CONFIRM_NO:
         return False
     return None
 
 
-def is_rpc_trigger(text: str):
+@lru_cache(maxsize=256)
+def intent_flags(text: str):
     """
-    급여/공제/전표 등 RPC 실행 모드용 키워드가 들어있으면 True
+    (RPC 키워드, 실행 의도, 조회 의도) 포함 여부를 한 번의 스캔으로 반환
+    (extract_* 와 같이 같은 문장은 캐시 → 불변 tuple이라 그대로 공유)
     """
-    return bool(re.search(r"(급여|세금|공제|지급|이체|송금|전표|분개)", text)) and (
-        is_execute_intent(text) or not is_query_intent(text)
-    )
+    rpc = exec_ = query = False
+    for m in _INTENT_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == "exec":
+            exec_ = True
+            if m.group(kind) in _EXEC_RPC_COMPOUNDS:
+                rpc = True
+        elif kind == "rpc":
+            rpc = True
+        else:
+            query = True
+        if rpc and exec_ and query:
+            break
+    return rpc, exec_, query
 
 
-def is_execute_intent(text: str) -> bool:
+def is_rpc_trigger(text: str):
     """
-    실질적인 실행 의도(계산, 처리, 전표 생성 등)가 있는 질문이면 True
+    급여/공제/전표 등 RPC 실행 모드용 키워드가 들어있으면 True
     """
-    t = text.strip()
-    return bool(re.search(r"(처리|실행|진행|계산|산정해|돌려|생성해|등록|전표생성|지급해)", t))
+    # 대부분의 질문은 RPC 키워드가 없음 → 통합 스캔 전에 부분 문자열 검사로 바로 반환
+    if not any(k in text for k in _RPC_KEYWORDS):
+        return False
+    rpc, exec_, query = intent_flags(text)
+    return rpc and (exec_ or not query)
 
 
-def is_query_intent(text: str) -> bool:
-    """
-    조회 의도(총액, 대장, 내역 등)가 포함된 질문인지 판별
-    """
-    t = text.strip()
-    return bool(re.search(r"(몇\s*명|인원|대상|총액|합계|금액|건수|결과|내역|리스트|상세|조회|보여줘)", t))
+# extract_period가 만드는 'YYYY-MM' → 'YYYY-MM-01' 미리 계산 (2020~2030년)
+_PERIOD_DATE = {
+    f"{y:04d}-{m:02d}": f"{y:04d}-{m:02d}-01"
+    for y in range(2020, 2031)
+    for m in range(1, 13)
+}
 
 
 def month_to_period_date(period_yyyy_mm: str):
     """
     '2026-01' 등 year-month를 '2026-01-01' 등 y-m-1 포맷으로 변환.
     """
+    hit = _PERIOD_DATE.get(period_yyyy_mm)
+    if hit:
+        return hit
+
+    # 범위 밖/비정규 입력('2035-3' 등)은 기존처럼 파싱
     y, m = period_yyyy_mm.split("-")
     return f"{int(y):04d}-{int(m):02d}-01"
 
@@ -999,21 +1298,57 @@ S_PAYMENT = "PAYMENT"
 S_JOURNAL = "JOURNAL"
 S_DONE = "DONE"
 
-STATE_LABEL = {
+STATE_LABEL = MappingProxyType({
     S_PAYROLL: "급여 산정(RPC)",
     S_TAX: "공제 검증(RPC)",
     S_PAYMENT: "지급 처리(RPC)",
     S_JOURNAL: "전표 생성(RPC)",
     S_DONE: "완료(RPC)",
-}
-
-# 시나리오 상태(메모리) 관리를 위한 래퍼
-memory = ScenarioMemoryManager(store=st.session_state, namespace="scenario_memory")
+})
+
+# 조회형 질문(ask_*) + 대상 run 라우팅(tax/pay/journal) 키워드 (공백 제거된 문자열 기준)
+#   - '지급라인'/'공제총액' 등은 앞 2글자로 라우팅 플래그도 함께 세움 (_RPC_ROUTE_PREFIX)
+_RPC_QUERY_KEYWORDS = (
+    ("headcount", ("인원", "몇명", "대상")),
+    ("total_gross", ("총급여", "gross")),
+    ("total_net", ("실지급", "net")),
+    ("total_ded", ("총공제", "공제총액", "deduction")),
+    ("payment_lines", ("지급라인", "지급내역", "지급건수", "이체건수")),
+    ("journal_lines", ("전표라인", "전표내역", "분개내역", "전표건수")),
+    ("tax", ("공제", "세금")),
+    ("pay", ("지급", "이체", "송금")),
+    ("journal", ("전표", "분개")),
+)
+_RPC_ROUTE_PREFIX = {"공제": "tax", "지급": "pay", "이체": "pay", "전표": "journal", "분개": "journal"}
+
+# 날짜가 전표일인지 판별하는 단어 (그 밖의 날짜는 모두 지급일로 취급)
+_JOURNAL_DATE_WORDS = ("전표", "분개", "전기")
+_RE_CANCEL = re.compile(r"(취소|종료|그만|중단|리셋|초기화)")
+# 급여→공제→지급→전표 일괄 실행 요청 ('전체'는 scope=ALL 키워드와 겹치므로 사용하지 않음)
+_RE_RUN_ALL = re.compile(r"(일괄\s*(실행|처리|진행)|한\s*번에\s*(실행|처리|진행))")
+
+# 시나리오 응답의 다음 행동 칩 (읽기 전용 → 모듈 상수 tuple을 공유)
+_SUG_YES_NO_END = ("예", "아니오", "시나리오 종료")
+_SUG_START = ("2026년 1월 전직원 급여 처리", "시나리오 종료")
+_SUG_RETRY = ("다시 시도", "시나리오 종료")
+_SUG_PAY_INPUT = ("25일 지급", "2026-01-25 지급", "시나리오 종료")
+_SUG_JOURNAL_INPUT = ("2026-01-31 전표", "1/31 전표", "시나리오 종료")
+_SUG_QUERY = ("전체 프로세스 요약", "시나리오 종료")
+
+# ctx["history"] 최대 보관 개수 (재시도가 반복돼도 세션 상태가 무한히 커지지 않도록)
+RPC_HISTORY_MAX = 64
+
+# 시나리오 상태(메모리) 관리를 위한 래퍼 (저장 시에도 같은 상한으로 history를 자름)
+memory = ScenarioMemoryManager(
+    store=st.session_state, namespace="scenario_memory", max_history=RPC_HISTORY_MAX
+)
 
 
 def rpc_get_ctx(session_id: str) -> dict:
     """
     세션별 RPC 시나리오 컨텍스트 상태(dict) 읽기 (없으면 빈 dict)
+    - session_state 안의 OrderedDict 조회일 뿐 직렬화/복사가 없으므로 별도 캐시를 두지 않음
+      (스크립트 전역 dict는 리런마다 다시 만들어지고, cache_resource는 세션 간에 공유되어 부적합)
     """
     return memory.get(session_id) or {}
 
@@ -1025,6 +1360,16 @@ def rpc_set_ctx(session_id: str, ctx: dict):
     memory.set(session_id, ctx)
 
 
+def _push_history(ctx: dict, state: str, run_id: str):
+    """
+    단계 실행 기록을 ctx["history"]에 추가 (최근 RPC_HISTORY_MAX개만 남김)
+    """
+    history = ctx["history"]
+    history.append({"state": state, "run_id": run_id})
+    if len(history) > RPC_HISTORY_MAX:
+        del history[:-RPC_HISTORY_MAX]
+
+
 def rpc_clear_ctx(session_id: str):
     """
     세션별 RPC 시나리오 상태/메모리 초기화(삭제)
@@ -1032,44 +1377,294 @@ def rpc_clear_ctx(session_id: str):
     memory.clear(session_id)
 
 
-def rpc_fetch_run(run_id: str):
-    """
-    process_runs 테이블에서 단일 run_id의 기록(상태, 요약 등)을 조회하고 sql 문자열도 같이 반환.
-    """
-    sql = f"""
-    select run_id, process_type, period, scope, status, params, summary, error_msg, started_at, finished_at
-    from public.process_runs
-    where run_id = '{run_id}';
-    """
-    return exec_sql(sql), sql.strip()
+# 완료된 run의 summary/요약 키 값/라인 건수는 더 바뀌지 않으므로 세션 단위 LRU로 재사용
+RUN_CACHE_MAX = 32
+RUN_FINAL_STATUSES = frozenset(("DONE", "FAILED"))
 
 
-def rpc_fetch_lines(run_id: str):
-    """
-    process_run_lines 테이블에서 특정 배치(run)의 라인(세부 지급/전표 행)들을 조회.
-    """
-    sql = f"""
-    select line_id, line_type, data, created_at
-    from public.process_run_lines
-    where run_id = '{run_id}'
-    order by line_id;
-    """
-    return exec_sql(sql), sql.strip()
+def _run_cache() -> OrderedDict:
+    cache = st.session_state.get("rpc_run_cache")
+    if cache is None:
+        cache = st.session_state.rpc_run_cache = OrderedDict()
+    return cache
 
 
-def rpc_answer_query_from_refs(ctx: dict, user_text: str):
-    """
+def _run_cache_get(key):
+    cache = _run_cache()
+    hit = cache.get(key)
+    if hit is not None:
+        cache.move_to_end(key)
+    return hit
+
+
+def _run_cache_put(key, value):
+    cache = _run_cache()
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > RUN_CACHE_MAX:
+        cache.popitem(last=False)
+
+
+_SQL_RUN_SUMMARY = """
+    select status, summary
+    from public.process_runs
+    where run_id = cast(:run_id as uuid);
+    """
+
+_SQL_RUN_SUMMARY_AND_LINES = """
+    select r.status, r.summary,
+           coalesce((
+               select json_agg(json_build_array(l.line_id, l.line_type, l.data, l.created_at) order by l.line_id)
+               from public.process_run_lines l
+               where l.run_id = r.run_id
+           ), '[]'::json) as lines
+    from public.process_runs r
+    where r.run_id = cast(:run_id as uuid);
+    """
+
+
+def _is_final_status(status) -> bool:
+    """
+    process_runs.status가 종료 상태(DONE/FAILED)인지 (대소문자 무시)
+    """
+    return str(status).upper() in RUN_FINAL_STATUSES
+
+
+def _store_run_summary(run_id: str, status, summary, shown: str) -> dict:
+    """
+    조회한 summary 값을 dict로 정규화 (jsonb가 아니거나 NULL이면 {}).
+    종료된 run이면 (status, summary, sql 문자열)을 세션 캐시에 저장
+    """
+    summary = summary if isinstance(summary, dict) else {}
+    if _is_final_status(status):
+        _run_cache_put(("summary", run_id), (status, summary, shown))
+    return summary
+
+
+def _extract_run_id(res):
+    """
+    RPC 호출 결과(select rpc_...() as run_id)에서 run_id 하나를 꺼냄. 없거나 오류 문자열이면 None
+    """
+    try:
+        row = _to_rows(res)[0]
+        return row if isinstance(row, str) else row[0]
+    except (IndexError, TypeError):
+        return None
+
+
+def _summary_from_rows(run_id: str, rows, shown: str):
+    """
+    _SQL_RUN_SUMMARY 결과 행 → (status, summary dict, sql 문자열). 종료된 run은 캐시에 저장
+    """
+    rows = _to_rows(rows)
+    if not rows:
+        return None, {}, shown
+
+    status, summary = rows[0]
+    return status, _store_run_summary(run_id, status, summary, shown), shown
+
+
+def _summary_and_lines_from_rows(run_id: str, rows, shown: str):
+    """
+    _SQL_RUN_SUMMARY_AND_LINES 결과 행 → (status, summary dict, 라인 행 리스트, sql 문자열)
+    """
+    rows = _to_rows(rows)
+    if not rows:
+        return None, {}, [], shown
+
+    status, summary, lines = rows[0]
+    summary = _store_run_summary(run_id, status, summary, shown)
+    return status, summary, [tuple(line) for line in (lines or [])], shown
+
+
+def rpc_fetch_summary(run_id: str):
+    """
+    process_runs에서 단일 run_id의 상태(status)와 요약(summary jsonb)만 조회.
+    반환: (status, summary dict, sql 문자열) — 호출부가 쓰는 두 컬럼만 가져와 전송량을 줄임.
+    """
+    hit = _run_cache_get(("summary", run_id))
+    if hit is not None:
+        return hit
+
+    params = {"run_id": run_id}
+    return _summary_from_rows(
+        run_id, exec_sql(_SQL_RUN_SUMMARY, params), sql_for_display(_SQL_RUN_SUMMARY, params)
+    )
+
+
+@lru_cache(maxsize=32)
+def _summary_scalars_sql(keys: tuple) -> str:
+    """
+    summary jsonb에서 keys만 꺼내는 SELECT 문 (keys는 코드 내 상수 → 문자열 조립 안전)
+    - ->> (text) 대신 -> (jsonb)로 꺼내 드라이버가 숫자를 숫자 그대로 돌려주게 함
+    - status도 함께 받아 종료된 run이면 꺼낸 값을 세션 캐시에 저장
+    """
+    cols = ", ".join(f"summary->'{k}' as \"{k}\"" for k in keys)
+    return f"""
+    select status, {cols}
+    from public.process_runs
+    where run_id = cast(:run_id as uuid);
+    """
+
+
+def rpc_fetch_summary_scalars(run_id: str, keys: tuple):
+    """
+    summary jsonb 전체 대신 필요한 키 값만 조회 (후속 질문 응답용).
+    종료된 run의 summary가 세션 캐시에 있으면 DB 조회 없이 거기서 꺼냄.
+    반환: ({key: 값}, sql 문자열)
+    """
+    hit = _run_cache_get(("summary", run_id))
+    if hit is not None:
+        _, summary, shown = hit
+        return {k: summary.get(k) for k in keys}, shown
+
+    # summary 전체는 없어도 같은 키를 이미 꺼낸 종료 run이면 재조회하지 않음 (같은 질문 반복)
+    hit = _run_cache_get(("scalars", run_id, keys))
+    if hit is not None:
+        return hit
+
+    sql = _summary_scalars_sql(keys)
+    params = {"run_id": run_id}
+    rows = _to_rows(exec_sql(sql, params))
+    if not rows:
+        return dict.fromkeys(keys), sql_for_display(sql, params)
+
+    status, *vals = rows[0]
+    res = dict(zip(keys, vals)), sql_for_display(sql, params)
+    if _is_final_status(status):
+        _run_cache_put(("scalars", run_id, keys), res)
+    return res
+
+
+_SQL_RUN_LINE_COUNT = """
+    select r.status,
+           (select count(*) from public.process_run_lines l where l.run_id = r.run_id)
+    from public.process_runs r
+    where r.run_id = cast(:run_id as uuid);
+    """
+
+
+def rpc_count_lines(run_id: str):
+    """
+    process_run_lines에서 특정 run의 라인 건수만 조회 (라인 전체 대신 count 스칼라 1개 전송).
+    run의 status도 같은 왕복에서 받아, summary 캐시가 없어도 종료된 run이면 건수를 캐시.
+    반환: (건수 int, sql 문자열)
+    """
+    hit = _run_cache_get(("line_count", run_id))
+    if hit is not None:
+        return hit
+
+    params = {"run_id": run_id}
+    rows = _to_rows(exec_sql(_SQL_RUN_LINE_COUNT, params))
+    if not rows:
+        return 0, sql_for_display(_SQL_RUN_LINE_COUNT, params)
+
+    status, cnt = rows[0]
+    res = int(cnt or 0), sql_for_display(_SQL_RUN_LINE_COUNT, params)
+    # 종료된 run의 건수만 캐시 (진행 중 run은 라인이 더 붙을 수 있음)
+    if _is_final_status(status):
+        _run_cache_put(("line_count", run_id), res)
+    return res
+
+
+_SQL_RUN_SUMMARIES = """
+    select run_id, status, summary
+    from public.process_runs
+    where run_id = any(cast(:run_ids as uuid[]));
+"""
+
+
+def _summaries_from_rows(rows, shown: str) -> dict:
+    """
+    _SQL_RUN_SUMMARIES 결과 행 → {run_id: (status, summary dict)}. 종료된 run은 캐시에 저장
+    """
+    out = {}
+    for run_id, status, summary in _to_rows(rows):
+        out[str(run_id)] = (status, _store_run_summary(str(run_id), status, summary, shown))
+    return out
+
+
+def rpc_run_full(period_date: str, scope_val: str, pay_date: str, journal_date: str):
+    """
+    급여 → 공제 → 지급 → 전표 RPC 4개를 하나의 SQL 문(CTE 체인)으로 실행.
+    각 단계가 앞 단계 run_id를 인자로 받으므로 실행 순서가 보장되고, 한 트랜잭션에서 커밋된다.
+    같은 트랜잭션에서 4개 run의 summary까지 이어서 조회 (별도 체크아웃/왕복 없음).
+    반환: ([payroll, tax, payment, journal] run_id 리스트 또는 None, sql 문자열, 원본 결과,
+           ({run_id: (status, summary dict)}, summary 조회 sql 문자열))
+    """
+    sql = """
+    with p as (
+        select public.rpc_payroll_run(cast(:period_date as date), :scope) as run_id
+    ), t as (
+        select public.rpc_tax_run(cast(:period_date as date), :scope,
+                                  cast((select run_id from p) as uuid)) as run_id
+    ), pm as (
+        select public.rpc_payment_run(cast(:period_date as date), :scope,
+                                      cast((select run_id from t) as uuid), cast(:pay_date as date)) as run_id
+    ), j as (
+        select public.rpc_journal_post(cast(:period_date as date), :scope,
+                                       cast((select run_id from pm) as uuid), cast(:journal_date as date)) as run_id
+    )
+    select (select run_id from p), (select run_id from t), (select run_id from pm), (select run_id from j);
+    """
+    params = {
+        "period_date": period_date,
+        "scope": scope_val,
+        "pay_date": pay_date,
+        "journal_date": journal_date,
+    }
+    res, summary_rows = exec_sql_chain(sql, params, _SQL_RUN_SUMMARIES, "run_ids", whole_row=True)
+    rows = _to_rows(res)
+    run_ids = [str(r) for r in rows[0]] if rows and all(rows[0]) else None
+
+    summaries = ({}, "")
+    if run_ids:
+        shown = sql_for_display(_SQL_RUN_SUMMARIES, {"run_ids": run_ids})
+        summaries = (_summaries_from_rows(summary_rows, shown), shown)
+    return run_ids, sql_for_display(sql, params), res, summaries
+
+
+def _normalize_ko(text: str) -> str:
+    """
+    공백 제거 + 영문 소문자화 ('총 급여' → '총급여', 'NET' → 'net')
+    - 조사(은/는/이/가...)는 '이체' 같은 키워드를 깨뜨리므로 제거하지 않음
+    """
+    return "".join(text.split()).lower()
+
+
+@lru_cache(maxsize=256)
+def rpc_query_flags(user_text: str) -> MappingProxyType:
+    """
+    조회형 질문 종류와 대상 run(공제/지급/전표) 키워드 포함 여부를 한 번에 판별
+    (정규화된 문자열에 대한 부분 문자열 검사)
+    칩 재클릭 등 같은 문장은 캐시에서 바로 반환 → 결과는 공유되므로 읽기 전용 매핑
+    """
+    nt = _normalize_ko(user_text)
+    flags = dict.fromkeys((name for name, _ in _RPC_QUERY_KEYWORDS), False)
+    for name, keywords in _RPC_QUERY_KEYWORDS:
+        for kw in keywords:
+            if kw in nt:
+                flags[name] = True
+                route = _RPC_ROUTE_PREFIX.get(kw[:2])
+                if route:
+                    flags[route] = True
+    return MappingProxyType(flags)
+
+
+def rpc_answer_query_from_refs(ctx: dict, user_text: str):
+    """
     시나리오 context(refs)에 직전 run_id들이 남아 있다면,
     사용자의 조회형 질문(user_text)에 맞는 정보를 즉답해주는 함수 (예: '전표 라인 몇 건?')
     """
     refs = (ctx or {}).get("refs", {}) or {}
 
-    ask_headcount = bool(re.search(r"(인원|몇\s*명|대상)", user_text))
-    ask_total_gross = bool(re.search(r"(총\s*급여|총급여|gross)", user_text))
-    ask_total_net = bool(re.search(r"(총\s*실지급|실지급|net)", user_text))
-    ask_total_ded = bool(re.search(r"(총\s*공제|공제\s*총액|deduction)", user_text))
-    ask_payment_lines = bool(re.search(r"(지급\s*라인|지급\s*내역|지급\s*건수|이체\s*건수)", user_text))
-    ask_journal_lines = bool(re.search(r"(전표\s*라인|전표\s*내역|분개\s*내역|전표\s*건수)", user_text))
+    ask = rpc_query_flags(user_text)
+    ask_headcount = ask["headcount"]
+    ask_total_gross = ask["total_gross"]
+    ask_total_net = ask["total_net"]
+    ask_total_ded = ask["total_ded"]
+    ask_payment_lines = ask["payment_lines"]
+    ask_journal_lines = ask["journal_lines"]
 
     payroll_run_id = refs.get("payroll_run_id")
     tax_run_id = refs.get("tax_run_id")
@@ -1077,59 +1672,54 @@ def rpc_answer_query_from_refs(ctx: dict, user_text: str):
     journal_run_id = refs.get("journal_run_id")
 
     target_run_id = payroll_run_id
-    if re.search(r"(공제|세금)", user_text) and tax_run_id:
+    if ask["tax"] and tax_run_id:
         target_run_id = tax_run_id
-    if re.search(r"(지급|이체|송금)", user_text) and payment_run_id:
+    if ask["pay"] and payment_run_id:
         target_run_id = payment_run_id
-    if re.search(r"(전표|분개)", user_text) and journal_run_id:
+    if ask["journal"] and journal_run_id:
         target_run_id = journal_run_id
 
     if not target_run_id:
         return None
 
-    run_row_res, sql_fetch = rpc_fetch_run(str(target_run_id))
-    rr = _to_rows(run_row_res)
-    summary = {}
-    if rr and isinstance(rr[0], (list, tuple)) and len(rr[0]) >= 7:
-        summary = rr[0][6] if isinstance(rr[0][6], dict) else {}
-
-    # 인원수 조회
+    # 인원수 조회 (급여 run 기준이라 target run 조회는 불필요)
+    #   - 이 경로의 DB 조회는 base run의 employee_count 1회뿐이고, 종료된 run이면 세션 캐시에서 바로 반환
     if ask_headcount:
         base_id = payroll_run_id or target_run_id
-        base_res, base_sql = rpc_fetch_run(str(base_id))
-        br = _to_rows(base_res)
-        base_summary = {}
-        if br and isinstance(br[0], (list, tuple)) and len(br[0]) >= 7:
-            base_summary = br[0][6] if isinstance(br[0][6], dict) else {}
-        n = base_summary.get("employee_count")
+        base_values, base_sql = rpc_fetch_summary_scalars(str(base_id), ("employee_count",))
+        n = base_values["employee_count"]
         reply = f"📌 급여 산정 대상 인원: **{n}명**"
         return {"reply": reply, "sqls": [base_sql]}
 
+    # 라인 건수 조회는 요약(summary)이 필요 없음 → run 조회 없이 count(*) 1회
+    #   (총급여/총공제/총실지급 질문이 우선이므로 그 경우는 아래로 진행)
+    if not (ask_total_gross or ask_total_ded or ask_total_net):
+        if ask_payment_lines and payment_run_id:
+            cnt, sql_count = rpc_count_lines(str(payment_run_id))
+            return {"reply": f"📌 지급 라인 건수: **{cnt}건**", "sqls": [sql_count]}
+
+        if ask_journal_lines and journal_run_id:
+            cnt, sql_count = rpc_count_lines(str(journal_run_id))
+            return {"reply": f"📌 전표 라인 건수: **{cnt}건**", "sqls": [sql_count]}
+
+    # 금액 질문은 필요한 summary 키만 조회
     if ask_total_gross:
-        v = summary.get("total_gross")
+        values, sql_fetch = rpc_fetch_summary_scalars(str(target_run_id), ("total_gross",))
+        v = values["total_gross"]
         return {"reply": f"📌 총급여: **{fmt_won(v)}**", "sqls": [sql_fetch]}
 
     if ask_total_ded:
-        v = summary.get("total_deductions")
+        values, sql_fetch = rpc_fetch_summary_scalars(str(target_run_id), ("total_deductions",))
+        v = values["total_deductions"]
         return {"reply": f"📌 총공제: **{fmt_won(v)}**", "sqls": [sql_fetch]}
 
     if ask_total_net:
-        v = summary.get("total_net_pay") or summary.get("pay_total")
+        values, sql_fetch = rpc_fetch_summary_scalars(str(target_run_id), ("total_net_pay", "pay_total"))
+        v = values["total_net_pay"] or values["pay_total"]
         return {"reply": f"📌 총실지급: **{fmt_won(v)}**", "sqls": [sql_fetch]}
 
-    if ask_payment_lines and payment_run_id:
-        lines_res, sql_lines = rpc_fetch_lines(str(payment_run_id))
-        rows = _to_rows(lines_res)
-        cnt = len(rows)
-        return {"reply": f"📌 지급 라인 건수: **{cnt}건**", "sqls": [sql_lines]}
-
-    if ask_journal_lines and journal_run_id:
-        lines_res, sql_lines = rpc_fetch_lines(str(journal_run_id))
-        rows = _to_rows(lines_res)
-        cnt = len(rows)
-        return {"reply": f"📌 전표 라인 건수: **{cnt}건**", "sqls": [sql_lines]}
-
     # 그 외에는 요약 내용 전체 전달
+    _, summary, sql_fetch = rpc_fetch_summary(str(target_run_id))
     return {"reply": f"📌 요약: {summary}", "sqls": [sql_fetch]}
 
 
@@ -1137,17 +1727,15 @@ def rpc_run(session_id: str, user_text: str) -> dict:
     """
     급여~전표 각 단계별로 조건, 확인 등을 체크하며
     각 시나리오 진행을 담당하는 오케스트레이터 함수. 상태기반 분기/실행
+    - ctx는 로컬에서만 갱신하고, 저장(또는 종료 시 삭제)은 턴마다 finally에서 한 번만 수행
     """
-    ctx = rpc_get_ctx(session_id)
-    active = ctx.get("active_scenario") == RPC_ACTIVE
-    confirm = extract_confirm(user_text)
-
-    if re.search(r"(취소|종료|그만|중단|리셋|초기화)", user_text):
+    if _RE_CANCEL.search(user_text):
         rpc_clear_ctx(session_id)
         return {"handled": True, "reply": "RPC 급여 시나리오를 종료했습니다.", "state": None,
-                "suggestions": [], "artifacts": {"rpc_sqls": []}}
+                "suggestions": (), "artifacts": {"rpc_sqls": []}}
 
-    if not active:
+    ctx = rpc_get_ctx(session_id)
+    if ctx.get("active_scenario") != RPC_ACTIVE:
         ctx = {
             "active_scenario": RPC_ACTIVE,
             "state": S_PAYROLL,
@@ -1156,536 +1744,705 @@ def rpc_run(session_id: str, user_text: str) -> dict:
             "history": [],
         }
 
-    if is_query_intent(user_text) and confirm is None and ctx.get("refs"):
-        q = rpc_answer_query_from_refs(ctx, user_text)
-        if q:
+    out = None
+    try:
+        out = _rpc_step(ctx, user_text)
+        return out
+    finally:
+        # state=None 응답은 시나리오 종료 → 저장 대신 삭제
+        if out is not None and out.get("state") is None:
+            rpc_clear_ctx(session_id)
+        else:
             rpc_set_ctx(session_id, ctx)
-            return {"handled": True, "reply": q["reply"], "state": ctx.get("state"),
-                    "suggestions": ["전체 프로세스 요약", "시나리오 종료"],
-                    "artifacts": {"rpc_sqls": q.get("sqls", [])}}
 
-    slots = ctx.get("slots", {})
 
-    if is_query_intent(user_text) and not is_execute_intent(user_text) and confirm is None:
-        if ctx.get("refs"):
-            q = rpc_answer_query_from_refs(ctx, user_text)
-            if q:
-                rpc_set_ctx(session_id, ctx)
-                return {
-                    "handled": True,
-                    "reply": q["reply"],
-                    "state": ctx.get("state"),
-                    "suggestions": ["전체 프로세스 요약", "시나리오 종료"],
-                    "artifacts": {"rpc_sqls": q.get("sqls", [])},
-                }
+def _parse_md(rest: str, period_yyyy_mm: str) -> str:
+    """
+    "__MD__:m:d"의 "m:d" 부분 → period 연도 기준 yyyy-mm-dd
+    """
+    mm, dd = rest.split(":")
+    y = int(period_yyyy_mm.split("-")[0])
+    return f"{y:04d}-{int(mm):02d}-{int(dd):02d}"
 
-    period = extract_period(user_text)
-    scope = extract_scope(user_text)
-    any_date = extract_date_any(user_text)
 
-    if period:
-        slots["period"] = period
-    if scope:
-        slots["scope"] = scope
+def _parse_day(rest: str, period_yyyy_mm: str) -> str:
+    """
+    "__DAY__:d"의 "d" 부분 → period 연·월 기준 yyyy-mm-dd
+    """
+    y, m = period_yyyy_mm.split("-")
+    return f"{int(y):04d}-{int(m):02d}-{int(rest):02d}"
 
-    if any_date:
-        if re.search(r"(전표|분개|전기)", user_text):
-            slots["journal_date_raw"] = any_date
-        elif re.search(r"(지급|이체|송금)", user_text):
-            slots["pay_date_raw"] = any_date
-        else:
-            slots["pay_date_raw"] = any_date
 
-    ctx["slots"] = slots
+# extract_date_any가 만드는 약식 날짜 prefix → 변환 함수
+_SHORT_DATE_PARSERS = {
+    "__MD__": _parse_md,
+    "__DAY__": _parse_day,
+}
 
-    def resolve_md(raw, period_yyyy_mm):
-        """
-        __MD__ 형식 등 약식 날짜를 yyyy-mm-dd로 변환
-        """
-        if not raw:
-            return None
-        if raw.startswith("__MD__:"):
-            _, mm, dd = raw.split(":")
-            y = int(period_yyyy_mm.split("-")[0])
-            return f"{y:04d}-{int(mm):02d}-{int(dd):02d}"
-        if raw.startswith("__DAY__:"):
-            dd = int(raw.split(":")[1])
-            y, m = period_yyyy_mm.split("-")
-            return f"{int(y):04d}-{int(m):02d}-{dd:02d}"
-        return raw
 
-    state = ctx.get("state") or S_PAYROLL
+@lru_cache(maxsize=256)
+def _resolve_md(raw, period_yyyy_mm):
+    """
+    __MD__ 형식 등 약식 날짜를 yyyy-mm-dd로 변환
+    """
+    if not raw:
+        return None
+    # prefix를 한 번만 잘라 테이블 조회 (yyyy-mm-dd 등 prefix가 없으면 그대로 반환)
+    prefix, _, rest = raw.partition(":")
+    parse = _SHORT_DATE_PARSERS.get(prefix)
+    return parse(rest, period_yyyy_mm) if parse else raw
+
+
+def _handle_run_all(ctx: dict, user_text: str, confirm) -> dict:
+    """
+    일괄 실행: 급여 → 공제 → 지급 → 전표 4개 RPC를 한 번에 호출 (급여 산정 전 단계에서만)
+    필요한 슬롯이 모두 채워지면 해석된 지급일/전표일을 보여주고 확인(예) 후에만 실행
+    """
+    slots = ctx["slots"]
+    period_yyyy_mm = ctx["slots"].get("period")
+    scope_val = ctx["slots"].get("scope")
     rpc_sqls = []
 
-    period_yyyy_mm = slots.get("period")
-    scope_val = slots.get("scope")
-
-    # 이하 단계별 긴 분기(급여 산정, 공제, 지급, 전표, 완료)는 기존처럼 주석 생략 (상세 설명은 위 안내 참고)
-    # state별 블록 내부 로직에는 주석이 있으니 생략 (중복될 우려 있음!)
-
-    # -------------------------
-    # S_PAYROLL
-    # -------------------------
-    if state == S_PAYROLL:
-        if not period_yyyy_mm or not scope_val:
-            miss = []
-            if not period_yyyy_mm: miss.append("period(예: 2026년 1월)")
-            if not scope_val: miss.append("scope(예: 전직원/영업부)")
-            reply = (
-                "RPC 급여(프로시저) 실행을 위해 정보가 필요합니다.\n"
-                f"- 누락: {', '.join(miss)}\n"
-                "- 예: '2026년 1월 전직원 급여 처리'\n"
-                "- 예: '1월 영업부 급여 처리'"
-            )
-            ctx["state"] = S_PAYROLL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": reply,
-                "state": ctx["state"],
-                "suggestions": ["2026년 1월 전직원 급여 처리", "이번달 전직원 급여 처리", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    if confirm is False:
+        ctx.pop("run_all", None)
+        return {
+            "handled": True,
+            "reply": "일괄 실행을 취소했습니다. 단계별로 진행하려면 '2026년 1월 전직원 급여 처리'처럼 입력해줘.",
+            "state": S_PAYROLL,
+            "suggestions": _SUG_START,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        period_date = month_to_period_date(period_yyyy_mm)
-        sql_call = f"select public.rpc_payroll_run('{period_date}'::date, '{scope_val}') as run_id;"
-        run_id_res = exec_sql(sql_call)
-        rpc_sqls.append(sql_call)
+    ctx["run_all"] = True
+    pay_date = _resolve_md(slots.get("pay_date_raw"), period_yyyy_mm) if period_yyyy_mm else None
+    journal_date = _resolve_md(slots.get("journal_date_raw"), period_yyyy_mm) if period_yyyy_mm else None
 
-        rows = _to_rows(run_id_res)
-        run_id = None
-        if rows and isinstance(rows[0], (list, tuple)) and len(rows[0]) >= 1:
-            run_id = rows[0][0]
-        elif rows and isinstance(rows[0], str):
-            run_id = rows[0]
+    miss = []
+    if not period_yyyy_mm: miss.append("period(예: 2026년 1월)")
+    if not scope_val: miss.append("scope(예: 전직원/영업부)")
+    if not pay_date: miss.append("지급일(예: 25일 지급)")
+    if not journal_date: miss.append("전표일(예: 1/31 전표)")
+    if miss:
+        return {
+            "handled": True,
+            "reply": (
+                "급여 → 공제 → 지급 → 전표를 한 번에 실행하려면 정보가 더 필요합니다.\n"
+                f"- 누락: {', '.join(miss)}\n"
+                "(일괄 실행 모드입니다. '아니오'를 입력하면 일괄 실행을 취소하고 단계별로 진행합니다)"
+            ),
+            "state": S_PAYROLL,
+            "suggestions": ("25일 지급", "1/31 전표", "아니오", "시나리오 종료"),
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        if not run_id:
-            ctx["state"] = S_PAYROLL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "급여 RPC 호출은 실행했지만 run_id를 파싱하지 못했습니다. (DB 반환값 확인 필요)",
-                "state": ctx["state"],
-                "suggestions": ["다시 시도", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls, "result": run_id_res},
-            }
+    # 지급/전표 RPC는 되돌릴 수 없으므로 단계별 실행과 같이 해석된 날짜를 보여주고 확인 후 실행
+    if confirm is None:
+        return {
+            "handled": True,
+            "reply": (
+                "급여 → 공제 → 지급 → 전표를 한 번에 실행할까요?\n"
+                f"- period={period_yyyy_mm}\n"
+                f"- scope={scope_val}\n"
+                f"- pay_date={pay_date}\n"
+                f"- journal_date={journal_date}\n\n"
+                "예/아니오"
+            ),
+            "state": S_PAYROLL,
+            "suggestions": _SUG_YES_NO_END,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        ctx["refs"]["payroll_run_id"] = str(run_id)
-        ctx["history"].append({"state": S_PAYROLL, "run_id": str(run_id)})
+    run_ids, sql_call, run_res, (summaries, sql_fetch) = rpc_run_full(
+        month_to_period_date(period_yyyy_mm), scope_val, pay_date, journal_date
+    )
+    rpc_sqls.append(sql_call)
+    ctx.pop("run_all", None)
 
-        run_row_res, sql_fetch = rpc_fetch_run(str(run_id))
-        rpc_sqls.append(sql_fetch)
+    if not run_ids:
+        return {
+            "handled": True,
+            "reply": "일괄 RPC 호출은 실행했지만 run_id를 파싱하지 못했습니다. (DB 반환값 확인 필요)",
+            "state": S_PAYROLL,
+            "suggestions": _SUG_RETRY,
+            "artifacts": {"rpc_sqls": rpc_sqls, "result": run_res},
+        }
 
-        rr = _to_rows(run_row_res)
-        summary = {}
-        status = None
-        if rr and isinstance(rr[0], (list, tuple)) and len(rr[0]) >= 7:
-            status = rr[0][4]
-            summary = rr[0][6] if isinstance(rr[0][6], dict) else {}
+    steps = (
+        (S_PAYROLL, "payroll_run_id"),
+        (S_TAX, "tax_run_id"),
+        (S_PAYMENT, "payment_run_id"),
+        (S_JOURNAL, "journal_run_id"),
+    )
+    for (step_state, ref_key), run_id in zip(steps, run_ids):
+        ctx["refs"][ref_key] = run_id
+        _push_history(ctx, step_state, run_id)
+
+    rpc_sqls.append(sql_fetch)
+
+    ctx["state"] = S_DONE
+
+    payroll_sum = summaries.get(run_ids[0], (None, {}))[1]
+    payment_sum = summaries.get(run_ids[2], (None, {}))[1]
+    journal_sum = summaries.get(run_ids[3], (None, {}))[1]
+    reply = (
+        "✅ [RPC] 급여 → 공제 → 지급 → 전표 일괄 실행 완료\n"
+        f"- payroll_run_id: {run_ids[0]}\n"
+        f"- tax_run_id: {run_ids[1]}\n"
+        f"- payment_run_id: {run_ids[2]}\n"
+        f"- journal_run_id: {run_ids[3]}\n"
+        f"- 대상 인원: {payroll_sum.get('employee_count')}명\n"
+        f"- 총실지급: {fmt_won(payroll_sum.get('total_net_pay'))}\n"
+        f"- 지급총액: {fmt_won(payment_sum.get('pay_total'))} (지급일 {pay_date})\n"
+        f"- 차대일치: {journal_sum.get('balanced')} (전표일 {journal_date})\n"
+    )
+    return {
+        "handled": True,
+        "reply": reply,
+        "state": ctx["state"],
+        "suggestions": ("총급여는?", "전표 라인 몇 건?", "시나리오 종료"),
+        "artifacts": {"rpc_sqls": rpc_sqls, "run_ids": run_ids, "summaries": summaries},
+    }
 
-        ctx["state"] = S_TAX
-        rpc_set_ctx(session_id, ctx)
 
+def _handle_payroll(ctx: dict, user_text: str, confirm) -> dict:
+    """
+    급여 산정 단계: period/scope 확인 후 rpc_payroll_run 실행
+    """
+    period_yyyy_mm = ctx["slots"].get("period")
+    scope_val = ctx["slots"].get("scope")
+    rpc_sqls = []
+
+    # 일괄 실행 모드는 그 안내(누락 정보/확인)에 답하는 동안만 유지
+    #   - '일괄' 없이 다시 급여 처리를 요청하면 모드를 풀고 단계별 흐름으로 진행
+    if _RE_RUN_ALL.search(user_text):
+        return _handle_run_all(ctx, user_text, confirm)
+    if ctx.get("run_all"):
+        if "급여" not in user_text:
+            return _handle_run_all(ctx, user_text, confirm)
+        ctx.pop("run_all", None)
+
+    if not period_yyyy_mm or not scope_val:
+        miss = []
+        if not period_yyyy_mm: miss.append("period(예: 2026년 1월)")
+        if not scope_val: miss.append("scope(예: 전직원/영업부)")
         reply = (
-            "✅ [RPC] 급여 산정 실행 완료\n"
-            f"- run_id: {run_id}\n"
+            "RPC 급여(프로시저) 실행을 위해 정보가 필요합니다.\n"
+            f"- 누락: {', '.join(miss)}\n"
+            "- 예: '2026년 1월 전직원 급여 처리'\n"
+            "- 예: '1월 영업부 급여 처리'"
         )
-        if summary:
-            reply += (
-                f"- 대상 인원: {summary.get('employee_count')}명\n"
-                f"- 총급여: {fmt_won(summary.get('total_gross'))}\n"
-                f"- 총공제: {fmt_won(summary.get('total_deductions'))}\n"
-                f"- 총실지급: {fmt_won(summary.get('total_net_pay'))}\n"
-            )
-        reply += "\n다음 단계로 **공제 검증(RPC)** 을 진행할까요?"
-
+        ctx["state"] = S_PAYROLL
         return {
             "handled": True,
             "reply": reply,
             "state": ctx["state"],
-            "suggestions": ["공제 검증 진행", "시나리오 종료"],
-            "artifacts": {"rpc_sqls": rpc_sqls, "run_id": str(run_id), "summary": summary, "status": status},
+            "suggestions": ("2026년 1월 전직원 급여 처리", "이번달 전직원 급여 처리", "시나리오 종료"),
+            "artifacts": {"rpc_sqls": rpc_sqls},
         }
 
-    # -------------------------
-    # S_TAX
-    # -------------------------
-    if state == S_TAX:
-        if not period_yyyy_mm or not scope_val:
-            ctx["state"] = S_PAYROLL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "공제 검증 전에 period/scope가 필요합니다. 예: '2026년 1월 전직원 급여 처리'",
-                "state": ctx["state"],
-                "suggestions": ["2026년 1월 전직원 급여 처리", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    period_date = month_to_period_date(period_yyyy_mm)
+    sql_call = "select public.rpc_payroll_run(cast(:period_date as date), :scope) as run_id;"
+    params = {"period_date": period_date, "scope": scope_val}
+    # RPC 호출 + summary 조회를 한 트랜잭션에서 연달아 실행
+    run_id_res, fetch_rows = exec_sql_chain(sql_call, params, _SQL_RUN_SUMMARY, "run_id")
+    rpc_sqls.append(sql_for_display(sql_call, params))
 
-        payroll_run_id = ctx["refs"].get("payroll_run_id")
-        if not payroll_run_id:
-            ctx["state"] = S_PAYROLL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "공제 검증 전에 급여 실행(run_id)이 필요합니다. 먼저 '급여 처리'부터 해줘.",
-                "state": ctx["state"],
-                "suggestions": ["급여 처리", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    run_id = _extract_run_id(run_id_res)
 
-        period_date = month_to_period_date(period_yyyy_mm)
-        sql_call = f"select public.rpc_tax_run('{period_date}'::date, '{scope_val}', '{payroll_run_id}'::uuid) as run_id;"
-        run_id_res = exec_sql(sql_call)
-        rpc_sqls.append(sql_call)
+    if not run_id:
+        ctx["state"] = S_PAYROLL
+        return {
+            "handled": True,
+            "reply": "급여 RPC 호출은 실행했지만 run_id를 파싱하지 못했습니다. (DB 반환값 확인 필요)",
+            "state": ctx["state"],
+            "suggestions": _SUG_RETRY,
+            "artifacts": {"rpc_sqls": rpc_sqls, "result": run_id_res},
+        }
 
-        rows = _to_rows(run_id_res)
-        run_id = rows[0][0] if rows and isinstance(rows[0], (list, tuple)) else None
+    ctx["refs"]["payroll_run_id"] = str(run_id)
+    _push_history(ctx, S_PAYROLL, str(run_id))
 
-        ctx["refs"]["tax_run_id"] = str(run_id)
-        ctx["history"].append({"state": S_TAX, "run_id": str(run_id)})
+    status, summary, sql_fetch = _summary_from_rows(
+        str(run_id), fetch_rows, sql_for_display(_SQL_RUN_SUMMARY, {"run_id": str(run_id)})
+    )
+    rpc_sqls.append(sql_fetch)
+
+    ctx["state"] = S_TAX
 
-        run_row_res, sql_fetch = rpc_fetch_run(str(run_id))
-        rpc_sqls.append(sql_fetch)
+    reply = (
+        "✅ [RPC] 급여 산정 실행 완료\n"
+        f"- run_id: {run_id}\n"
+    )
+    if summary:
+        reply += (
+            f"- 대상 인원: {summary.get('employee_count')}명\n"
+            f"- 총급여: {fmt_won(summary.get('total_gross'))}\n"
+            f"- 총공제: {fmt_won(summary.get('total_deductions'))}\n"
+            f"- 총실지급: {fmt_won(summary.get('total_net_pay'))}\n"
+        )
+    reply += "\n다음 단계로 **공제 검증(RPC)** 을 진행할까요?"
 
-        rr = _to_rows(run_row_res)
-        summary = {}
-        if rr and isinstance(rr[0], (list, tuple)) and len(rr[0]) >= 7:
-            summary = rr[0][6] if isinstance(rr[0][6], dict) else {}
+    return {
+        "handled": True,
+        "reply": reply,
+        "state": ctx["state"],
+        "suggestions": ("공제 검증 진행", "시나리오 종료"),
+        "artifacts": {"rpc_sqls": rpc_sqls, "run_id": str(run_id), "summary": summary, "status": status},
+    }
 
-        ctx["state"] = S_PAYMENT
-        rpc_set_ctx(session_id, ctx)
 
-        reply = (
-            "✅ [RPC] 공제 검증 완료\n"
-            f"- run_id: {run_id}\n"
-        )
-        if summary:
-            rate = summary.get("avg_deduction_rate", 0)
-            try:
-                rate_pct = float(rate) * 100.0
-            except Exception:
-                rate_pct = rate
-            reply += (
-                f"- 총급여: {fmt_won(summary.get('total_gross'))}\n"
-                f"- 총공제: {fmt_won(summary.get('total_deductions'))}\n"
-                f"- 총실지급: {fmt_won(summary.get('total_net_pay'))}\n"
-                f"- 평균 공제율: {rate_pct:.2f}%\n"
-                f"- 공제 0원 인원: {summary.get('zero_deduction_count')}명\n"
-            )
-        reply += "\n다음 단계로 **지급 처리(RPC)** 를 진행할까요? 지급일을 입력해줘."
+def _handle_tax(ctx: dict, user_text: str, confirm) -> dict:
+    """
+    공제 검증 단계: 확인(예/아니오) 후 rpc_tax_run 실행
+    """
+    period_yyyy_mm = ctx["slots"].get("period")
+    scope_val = ctx["slots"].get("scope")
+    rpc_sqls = []
 
+    if not period_yyyy_mm or not scope_val:
+        ctx["state"] = S_PAYROLL
         return {
             "handled": True,
-            "reply": reply,
+            "reply": "공제 검증 전에 period/scope가 필요합니다. 예: '2026년 1월 전직원 급여 처리'",
             "state": ctx["state"],
-            "suggestions": ["25일 지급", "2026-01-25 지급", "시나리오 종료"],
-            "artifacts": {"rpc_sqls": rpc_sqls, "run_id": str(run_id), "summary": summary},
+            "suggestions": _SUG_START,
+            "artifacts": {"rpc_sqls": rpc_sqls},
         }
 
-    # -------------------------
-    # S_PAYMENT
-    # -------------------------
-    if state == S_PAYMENT:
-        tax_run_id = ctx["refs"].get("tax_run_id")
-        if not tax_run_id:
-            ctx["state"] = S_TAX
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "지급 처리 전에 공제 검증(run_id)이 필요합니다. '공제 검증 진행'을 먼저 해줘.",
-                "state": ctx["state"],
-                "suggestions": ["공제 검증 진행", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    payroll_run_id = ctx["refs"].get("payroll_run_id")
+    if not payroll_run_id:
+        ctx["state"] = S_PAYROLL
+        return {
+            "handled": True,
+            "reply": "공제 검증 전에 급여 실행(run_id)이 필요합니다. 먼저 '급여 처리'부터 해줘.",
+            "state": ctx["state"],
+            "suggestions": ("급여 처리", "시나리오 종료"),
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        if not period_yyyy_mm or not scope_val:
-            ctx["state"] = S_PAYROLL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "지급 처리 전에 period/scope가 필요합니다. '2026년 1월 전직원 급여 처리'부터 진행해줘.",
-                "state": ctx["state"],
-                "suggestions": ["2026년 1월 전직원 급여 처리", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    period_date = month_to_period_date(period_yyyy_mm)
+    sql_call = (
+        "select public.rpc_tax_run(cast(:period_date as date), :scope, "
+        "cast(:payroll_run_id as uuid)) as run_id;"
+    )
+    params = {"period_date": period_date, "scope": scope_val, "payroll_run_id": str(payroll_run_id)}
+    # RPC 호출 + summary 조회를 한 트랜잭션에서 연달아 실행
+    run_id_res, fetch_rows = exec_sql_chain(sql_call, params, _SQL_RUN_SUMMARY, "run_id")
+    rpc_sqls.append(sql_for_display(sql_call, params))
 
-        pay_date = resolve_md(slots.get("pay_date_raw"), period_yyyy_mm)
-        if not pay_date:
-            ctx["state"] = S_PAYMENT
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "지급일이 필요합니다. 예: '25일 지급' 또는 '2026-01-25 지급'",
-                "state": ctx["state"],
-                "suggestions": ["25일 지급", "2026-01-25 지급", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    run_id = _extract_run_id(run_id_res)
 
-        if confirm is None:
-            ctx["state"] = S_PAYMENT
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": (
-                    "지급 실행(배치 생성)을 진행할까요?\n"
-                    f"- period={period_yyyy_mm}\n"
-                    f"- scope={scope_val}\n"
-                    f"- pay_date={pay_date}\n\n"
-                    "예/아니오"
-                ),
-                "state": ctx["state"],
-                "suggestions": ["예", "아니오", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    ctx["refs"]["tax_run_id"] = str(run_id)
+    _push_history(ctx, S_TAX, str(run_id))
 
-        if confirm is False:
-            ctx["state"] = S_PAYMENT
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "지급 실행을 취소했습니다. (계속하려면 '예' 또는 지급일을 다시 입력해줘)",
-                "state": ctx["state"],
-                "suggestions": ["예", "25일 지급", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    _, summary, sql_fetch = _summary_from_rows(
+        str(run_id), fetch_rows, sql_for_display(_SQL_RUN_SUMMARY, {"run_id": str(run_id)})
+    )
+    rpc_sqls.append(sql_fetch)
+
+    ctx["state"] = S_PAYMENT
 
-        period_date = month_to_period_date(period_yyyy_mm)
-        sql_call = (
-            f"select public.rpc_payment_run('{period_date}'::date, '{scope_val}', "
-            f"'{tax_run_id}'::uuid, '{pay_date}'::date) as run_id;"
+    reply = (
+        "✅ [RPC] 공제 검증 완료\n"
+        f"- run_id: {run_id}\n"
+    )
+    if summary:
+        rate = summary.get("avg_deduction_rate", 0)
+        try:
+            rate_pct = float(rate) * 100.0
+        except Exception:
+            rate_pct = rate
+        reply += (
+            f"- 총급여: {fmt_won(summary.get('total_gross'))}\n"
+            f"- 총공제: {fmt_won(summary.get('total_deductions'))}\n"
+            f"- 총실지급: {fmt_won(summary.get('total_net_pay'))}\n"
+            f"- 평균 공제율: {rate_pct:.2f}%\n"
+            f"- 공제 0원 인원: {summary.get('zero_deduction_count')}명\n"
         )
-        run_id_res = exec_sql(sql_call)
-        rpc_sqls.append(sql_call)
+    reply += "\n다음 단계로 **지급 처리(RPC)** 를 진행할까요? 지급일을 입력해줘."
 
-        rows = _to_rows(run_id_res)
-        run_id = rows[0][0] if rows and isinstance(rows[0], (list, tuple)) else None
+    return {
+        "handled": True,
+        "reply": reply,
+        "state": ctx["state"],
+        "suggestions": _SUG_PAY_INPUT,
+        "artifacts": {"rpc_sqls": rpc_sqls, "run_id": str(run_id), "summary": summary},
+    }
 
-        ctx["refs"]["payment_run_id"] = str(run_id)
-        ctx["history"].append({"state": S_PAYMENT, "run_id": str(run_id)})
 
-        run_row_res, sql_fetch = rpc_fetch_run(str(run_id))
-        rpc_sqls.append(sql_fetch)
+def _handle_payment(ctx: dict, user_text: str, confirm) -> dict:
+    """
+    지급 단계: 지급일 + 확인 후 rpc_payment_run 실행
+    """
+    slots = ctx["slots"]
+    period_yyyy_mm = ctx["slots"].get("period")
+    scope_val = ctx["slots"].get("scope")
+    rpc_sqls = []
 
-        rr = _to_rows(run_row_res)
-        summary = {}
-        if rr and isinstance(rr[0], (list, tuple)) and len(rr[0]) >= 7:
-            summary = rr[0][6] if isinstance(rr[0][6], dict) else {}
+    tax_run_id = ctx["refs"].get("tax_run_id")
+    if not tax_run_id:
+        ctx["state"] = S_TAX
+        return {
+            "handled": True,
+            "reply": "지급 처리 전에 공제 검증(run_id)이 필요합니다. '공제 검증 진행'을 먼저 해줘.",
+            "state": ctx["state"],
+            "suggestions": ("공제 검증 진행", "시나리오 종료"),
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        ctx["state"] = S_JOURNAL
-        rpc_set_ctx(session_id, ctx)
+    if not period_yyyy_mm or not scope_val:
+        ctx["state"] = S_PAYROLL
+        return {
+            "handled": True,
+            "reply": "지급 처리 전에 period/scope가 필요합니다. '2026년 1월 전직원 급여 처리'부터 진행해줘.",
+            "state": ctx["state"],
+            "suggestions": _SUG_START,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        reply = (
-            "✅ [RPC] 지급 처리 완료\n"
-            f"- run_id: {run_id}\n"
-        )
-        if summary:
-            reply += (
-                f"- 성공 대상: {summary.get('success_count')}명\n"
-                f"- 오류: {summary.get('error_count')}건\n"
-                f"- 지급총액: {fmt_won(summary.get('pay_total'))}\n"
-                f"- 지급일: {summary.get('pay_date')}\n"
-            )
-        reply += "\n다음 단계로 **전표 생성(RPC)** 을 진행할까요? 전표일을 입력해줘."
+    pay_date = _resolve_md(slots.get("pay_date_raw"), period_yyyy_mm)
+    if not pay_date:
+        ctx["state"] = S_PAYMENT
+        return {
+            "handled": True,
+            "reply": "지급일이 필요합니다. 예: '25일 지급' 또는 '2026-01-25 지급'",
+            "state": ctx["state"],
+            "suggestions": _SUG_PAY_INPUT,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
+    if confirm is None:
+        ctx["state"] = S_PAYMENT
         return {
             "handled": True,
-            "reply": reply,
+            "reply": (
+                "지급 실행(배치 생성)을 진행할까요?\n"
+                f"- period={period_yyyy_mm}\n"
+                f"- scope={scope_val}\n"
+                f"- pay_date={pay_date}\n\n"
+                "예/아니오"
+            ),
             "state": ctx["state"],
-            "suggestions": ["2026-01-31 전표", "1/31 전표", "시나리오 종료"],
-            "artifacts": {"rpc_sqls": rpc_sqls, "run_id": str(run_id), "summary": summary},
+            "suggestions": _SUG_YES_NO_END,
+            "artifacts": {"rpc_sqls": rpc_sqls},
         }
 
-    # -------------------------
-    # S_JOURNAL
-    # -------------------------
-    if state == S_JOURNAL:
-        payment_run_id = ctx["refs"].get("payment_run_id")
-        if not payment_run_id:
-            ctx["state"] = S_PAYMENT
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "전표 생성 전에 지급 처리(run_id)가 필요합니다. 먼저 '지급'부터 진행해줘.",
-                "state": ctx["state"],
-                "suggestions": ["25일 지급", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    if confirm is False:
+        ctx["state"] = S_PAYMENT
+        return {
+            "handled": True,
+            "reply": "지급 실행을 취소했습니다. (계속하려면 '예' 또는 지급일을 다시 입력해줘)",
+            "state": ctx["state"],
+            "suggestions": ("예", "25일 지급", "시나리오 종료"),
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        if not period_yyyy_mm or not scope_val:
-            ctx["state"] = S_PAYROLL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "전표 생성 전에 period/scope가 필요합니다. '2026년 1월 전직원 급여 처리'부터 진행해줘.",
-                "state": ctx["state"],
-                "suggestions": ["2026년 1월 전직원 급여 처리", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    period_date = month_to_period_date(period_yyyy_mm)
+    sql_call = (
+        "select public.rpc_payment_run(cast(:period_date as date), :scope, "
+        "cast(:tax_run_id as uuid), cast(:pay_date as date)) as run_id;"
+    )
+    params = {
+        "period_date": period_date,
+        "scope": scope_val,
+        "tax_run_id": str(tax_run_id),
+        "pay_date": pay_date,
+    }
+    # RPC 호출 + summary 조회를 한 트랜잭션에서 연달아 실행
+    run_id_res, fetch_rows = exec_sql_chain(sql_call, params, _SQL_RUN_SUMMARY, "run_id")
+    rpc_sqls.append(sql_for_display(sql_call, params))
 
-        journal_date = resolve_md(slots.get("journal_date_raw"), period_yyyy_mm)
-        if not journal_date:
-            ctx["state"] = S_JOURNAL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "전표일이 필요합니다. 예: '2026-01-31 전표' 또는 '1/31 전표'",
-                "state": ctx["state"],
-                "suggestions": ["2026-01-31 전표", "1/31 전표", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    run_id = _extract_run_id(run_id_res)
 
-        if confirm is None:
-            ctx["state"] = S_JOURNAL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": (
-                    "전표 생성을 진행할까요? (전표 초안 생성)\n"
-                    f"- period={period_yyyy_mm}\n"
-                    f"- scope={scope_val}\n"
-                    f"- journal_date={journal_date}\n\n"
-                    "예/아니오"
-                ),
-                "state": ctx["state"],
-                "suggestions": ["예", "아니오", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    ctx["refs"]["payment_run_id"] = str(run_id)
+    _push_history(ctx, S_PAYMENT, str(run_id))
 
-        if confirm is False:
-            ctx["state"] = S_JOURNAL
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "전표 생성을 취소했습니다. (계속하려면 '예' 또는 전표일을 다시 입력해줘)",
-                "state": ctx["state"],
-                "suggestions": ["예", "2026-01-31 전표", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    _, summary, sql_fetch = _summary_from_rows(
+        str(run_id), fetch_rows, sql_for_display(_SQL_RUN_SUMMARY, {"run_id": str(run_id)})
+    )
+    rpc_sqls.append(sql_fetch)
+
+    ctx["state"] = S_JOURNAL
 
-        period_date = month_to_period_date(period_yyyy_mm)
-        sql_call = (
-            f"select public.rpc_journal_post('{period_date}'::date, '{scope_val}', "
-            f"'{payment_run_id}'::uuid, '{journal_date}'::date) as run_id;"
+    reply = (
+        "✅ [RPC] 지급 처리 완료\n"
+        f"- run_id: {run_id}\n"
+    )
+    if summary:
+        reply += (
+            f"- 성공 대상: {summary.get('success_count')}명\n"
+            f"- 오류: {summary.get('error_count')}건\n"
+            f"- 지급총액: {fmt_won(summary.get('pay_total'))}\n"
+            f"- 지급일: {summary.get('pay_date')}\n"
         )
-        run_id_res = exec_sql(sql_call)
-        rpc_sqls.append(sql_call)
+    reply += "\n다음 단계로 **전표 생성(RPC)** 을 진행할까요? 전표일을 입력해줘."
 
-        rows = _to_rows(run_id_res)
-        run_id = rows[0][0] if rows and isinstance(rows[0], (list, tuple)) else None
+    return {
+        "handled": True,
+        "reply": reply,
+        "state": ctx["state"],
+        "suggestions": _SUG_JOURNAL_INPUT,
+        "artifacts": {"rpc_sqls": rpc_sqls, "run_id": str(run_id), "summary": summary},
+    }
 
-        ctx["refs"]["journal_run_id"] = str(run_id)
-        ctx["history"].append({"state": S_JOURNAL, "run_id": str(run_id)})
 
-        run_row_res, sql_fetch = rpc_fetch_run(str(run_id))
-        rpc_sqls.append(sql_fetch)
+def _handle_journal(ctx: dict, user_text: str, confirm) -> dict:
+    """
+    전표 단계: 전표일 + 확인 후 rpc_journal_post 실행
+    """
+    slots = ctx["slots"]
+    period_yyyy_mm = ctx["slots"].get("period")
+    scope_val = ctx["slots"].get("scope")
+    rpc_sqls = []
 
-        rr = _to_rows(run_row_res)
-        summary = {}
-        if rr and isinstance(rr[0], (list, tuple)) and len(rr[0]) >= 7:
-            summary = rr[0][6] if isinstance(rr[0][6], dict) else {}
+    payment_run_id = ctx["refs"].get("payment_run_id")
+    if not payment_run_id:
+        ctx["state"] = S_PAYMENT
+        return {
+            "handled": True,
+            "reply": "전표 생성 전에 지급 처리(run_id)가 필요합니다. 먼저 '지급'부터 진행해줘.",
+            "state": ctx["state"],
+            "suggestions": ("25일 지급", "시나리오 종료"),
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        lines_res, sql_lines = rpc_fetch_lines(str(run_id))
-        rpc_sqls.append(sql_lines)
+    if not period_yyyy_mm or not scope_val:
+        ctx["state"] = S_PAYROLL
+        return {
+            "handled": True,
+            "reply": "전표 생성 전에 period/scope가 필요합니다. '2026년 1월 전직원 급여 처리'부터 진행해줘.",
+            "state": ctx["state"],
+            "suggestions": _SUG_START,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        ctx["state"] = S_DONE
-        rpc_set_ctx(session_id, ctx)
+    journal_date = _resolve_md(slots.get("journal_date_raw"), period_yyyy_mm)
+    if not journal_date:
+        ctx["state"] = S_JOURNAL
+        return {
+            "handled": True,
+            "reply": "전표일이 필요합니다. 예: '2026-01-31 전표' 또는 '1/31 전표'",
+            "state": ctx["state"],
+            "suggestions": _SUG_JOURNAL_INPUT,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
-        reply = (
-            "✅ [RPC] 전표 생성 완료(초안)\n"
-            f"- run_id: {run_id}\n"
-        )
-        if summary:
-            reply += (
-                f"- 차변 합계: {fmt_won(summary.get('debit_total'))}\n"
-                f"- 대변 합계: {fmt_won(summary.get('credit_total'))}\n"
-                f"- 차대일치: {summary.get('balanced')}\n"
-                f"- 전표일: {summary.get('journal_date')}\n"
-            )
-        reply += "\n전체 프로세스 요약을 보여드릴까요? (예/아니오)"
+    if confirm is None:
+        ctx["state"] = S_JOURNAL
+        return {
+            "handled": True,
+            "reply": (
+                "전표 생성을 진행할까요? (전표 초안 생성)\n"
+                f"- period={period_yyyy_mm}\n"
+                f"- scope={scope_val}\n"
+                f"- journal_date={journal_date}\n\n"
+                "예/아니오"
+            ),
+            "state": ctx["state"],
+            "suggestions": _SUG_YES_NO_END,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
 
+    if confirm is False:
+        ctx["state"] = S_JOURNAL
         return {
             "handled": True,
-            "reply": reply,
+            "reply": "전표 생성을 취소했습니다. (계속하려면 '예' 또는 전표일을 다시 입력해줘)",
             "state": ctx["state"],
-            "suggestions": ["예", "아니오", "시나리오 종료"],
-            "artifacts": {
-                "rpc_sqls": rpc_sqls,
-                "run_id": str(run_id),
-                "summary": summary,
-                "lines_result": lines_res,
-            },
+            "suggestions": ("예", "2026-01-31 전표", "시나리오 종료"),
+            "artifacts": {"rpc_sqls": rpc_sqls},
         }
 
-    # -------------------------
-    # S_DONE
-    # -------------------------
-    if state == S_DONE:
-        if is_query_intent(user_text) and not is_execute_intent(user_text) and confirm is None:
-            if ctx.get("refs"):
-                q = rpc_answer_query_from_refs(ctx, user_text)
-                if q:
-                    rpc_set_ctx(session_id, ctx)
-                    return {
-                        "handled": True,
-                        "reply": q["reply"],
-                        "state": ctx.get("state"),
-                        "suggestions": ["전체 프로세스 요약", "시나리오 종료"],
-                        "artifacts": {"rpc_sqls": q.get("sqls", [])},
-                    }
-
-        if re.search(r"(전체\s*요약|요약\s*보여줘|요약)", user_text) and confirm is None:
-            confirm = True
-
-        if confirm is None:
-            ctx["state"] = S_DONE
-            rpc_set_ctx(session_id, ctx)
-            return {
-                "handled": True,
-                "reply": "전체 프로세스 요약을 보여드릴까요? (예/아니오)",
-                "state": ctx["state"],
-                "suggestions": ["예", "아니오", "시나리오 종료"],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    period_date = month_to_period_date(period_yyyy_mm)
+    sql_call = (
+        "select public.rpc_journal_post(cast(:period_date as date), :scope, "
+        "cast(:payment_run_id as uuid), cast(:journal_date as date)) as run_id;"
+    )
+    params = {
+        "period_date": period_date,
+        "scope": scope_val,
+        "payment_run_id": str(payment_run_id),
+        "journal_date": journal_date,
+    }
+    # RPC 호출 + summary/lines 조회를 한 트랜잭션에서 연달아 실행
+    run_id_res, fetch_rows = exec_sql_chain(sql_call, params, _SQL_RUN_SUMMARY_AND_LINES, "run_id")
+    rpc_sqls.append(sql_for_display(sql_call, params))
 
-        if confirm is False:
-            rpc_clear_ctx(session_id)
-            return {
-                "handled": True,
-                "reply": "알겠습니다. RPC 시나리오를 종료했습니다.",
-                "state": None,
-                "suggestions": [],
-                "artifacts": {"rpc_sqls": rpc_sqls},
-            }
+    run_id = _extract_run_id(run_id_res)
 
-        refs = ctx.get("refs", {})
-        reply = (
-            "✅ [RPC] 급여 → 공제 → 지급 → 전표 요약\n"
-            f"- payroll_run_id: {refs.get('payroll_run_id')}\n"
-            f"- tax_run_id: {refs.get('tax_run_id')}\n"
-            f"- payment_run_id: {refs.get('payment_run_id')}\n"
-            f"- journal_run_id: {refs.get('journal_run_id')}\n"
+    ctx["refs"]["journal_run_id"] = str(run_id)
+    _push_history(ctx, S_JOURNAL, str(run_id))
+
+    # 전표 run 요약 + 라인을 한 번의 왕복으로 조회
+    _, summary, lines_res, sql_fetch = _summary_and_lines_from_rows(
+        str(run_id), fetch_rows, sql_for_display(_SQL_RUN_SUMMARY_AND_LINES, {"run_id": str(run_id)})
+    )
+    rpc_sqls.append(sql_fetch)
+
+    ctx["state"] = S_DONE
+
+    reply = (
+        "✅ [RPC] 전표 생성 완료(초안)\n"
+        f"- run_id: {run_id}\n"
+    )
+    if summary:
+        reply += (
+            f"- 차변 합계: {fmt_won(summary.get('debit_total'))}\n"
+            f"- 대변 합계: {fmt_won(summary.get('credit_total'))}\n"
+            f"- 차대일치: {summary.get('balanced')}\n"
+            f"- 전표일: {summary.get('journal_date')}\n"
         )
-        rpc_clear_ctx(session_id)
+    reply += "\n전체 프로세스 요약을 보여드릴까요? (예/아니오)"
+
+    return {
+        "handled": True,
+        "reply": reply,
+        "state": ctx["state"],
+        "suggestions": _SUG_YES_NO_END,
+        "artifacts": {
+            "rpc_sqls": rpc_sqls,
+            "run_id": str(run_id),
+            "summary": summary,
+            "lines_result": lines_res,
+        },
+    }
+
+
+def _handle_done(ctx: dict, user_text: str, confirm) -> dict:
+    """
+    완료 단계: 결과 질의 응답 또는 전체 요약 후 시나리오 종료
+    """
+    rpc_sqls = []
+
+    if "요약" in user_text and confirm is None:
+        confirm = True
+
+    if confirm is None:
+        ctx["state"] = S_DONE
         return {
             "handled": True,
-            "reply": reply,
+            "reply": "전체 프로세스 요약을 보여드릴까요? (예/아니오)",
+            "state": ctx["state"],
+            "suggestions": _SUG_YES_NO_END,
+            "artifacts": {"rpc_sqls": rpc_sqls},
+        }
+
+    if confirm is False:
+        return {
+            "handled": True,
+            "reply": "알겠습니다. RPC 시나리오를 종료했습니다.",
             "state": None,
-            "suggestions": [],
+            "suggestions": (),
             "artifacts": {"rpc_sqls": rpc_sqls},
         }
 
+    refs = ctx.get("refs", {})
+    reply = (
+        "✅ [RPC] 급여 → 공제 → 지급 → 전표 요약\n"
+        f"- payroll_run_id: {refs.get('payroll_run_id')}\n"
+        f"- tax_run_id: {refs.get('tax_run_id')}\n"
+        f"- payment_run_id: {refs.get('payment_run_id')}\n"
+        f"- journal_run_id: {refs.get('journal_run_id')}\n"
+    )
+    return {
+        "handled": True,
+        "reply": reply,
+        "state": None,
+        "suggestions": (),
+        "artifacts": {"rpc_sqls": rpc_sqls},
+    }
+
+
+def _handle_reset(ctx: dict, user_text: str, confirm) -> dict:
+    """
+    알 수 없는 상태: 급여 산정 단계로 되돌림
+    """
+    rpc_sqls = []
+
     ctx["state"] = S_PAYROLL
-    rpc_set_ctx(session_id, ctx)
     return {
         "handled": True,
         "reply": "상태가 꼬여서 처음 단계로 돌아갑니다. '2026년 1월 전직원 급여 처리'로 시작해줘.",
         "state": S_PAYROLL,
-        "suggestions": ["2026년 1월 전직원 급여 처리"],
+        "suggestions": ("2026년 1월 전직원 급여 처리",),
         "artifacts": {"rpc_sqls": rpc_sqls},
     }
 
 
+# state → 단계 처리 함수 (없는 state는 _handle_reset)
+_STATE_HANDLERS = {
+    S_PAYROLL: _handle_payroll,
+    S_TAX: _handle_tax,
+    S_PAYMENT: _handle_payment,
+    S_JOURNAL: _handle_journal,
+    S_DONE: _handle_done,
+}
+
+
+def _rpc_step(ctx: dict, user_text: str) -> dict:
+    """
+    rpc_run의 한 턴 처리 본문. 전달받은 ctx를 제자리에서 갱신하고 응답 dict를 반환
+    (시나리오를 끝내는 응답은 "state": None)
+    """
+    confirm = extract_confirm(user_text)
+
+    # 조회형 질문은 직전 run 결과로 즉답 (확인 단어만 입력된 턴은 의도 분류 자체를 생략)
+    #   - 여기서 답하지 못한 질문은 어느 단계에서도 refs로 답할 수 없으므로 한 번만 시도
+    if confirm is None and ctx.get("refs") and intent_flags(user_text)[2]:
+        q = rpc_answer_query_from_refs(ctx, user_text)
+        if q:
+            return {"handled": True, "reply": q["reply"], "state": ctx.get("state"),
+                    "suggestions": _SUG_QUERY,
+                    "artifacts": {"rpc_sqls": q.get("sqls", [])}}
+
+    slots = ctx.get("slots", {})
+
+    state = ctx.get("state") or S_PAYROLL
+    early = state in (S_PAYROLL, S_TAX)
+
+    # 지급 이후 단계의 범위(scope) 변경은 이미 실행한 급여/공제 run과 어긋남
+    #   → 슬롯에 반영하지 않고 처음부터 다시 진행하도록 안내 (날짜 단서 유무와 무관하게 확인)
+    if not early:
+        new_scope = extract_scope(user_text)
+        if new_scope and new_scope != slots.get("scope"):
+            return {
+                "handled": True,
+                "reply": (
+                    "지급 단계 이후에는 범위(scope)를 바꿀 수 없습니다. "
+                    "급여 산정과 공제 검증이 현재 범위로 이미 실행되었기 때문입니다.\n"
+                    f"- 현재 scope={slots.get('scope')} / 요청 scope={new_scope}\n"
+                    "범위를 바꾸려면 시나리오를 종료하고 급여 처리부터 다시 시작해줘."
+                ),
+                "state": state,
+                "suggestions": ("시나리오 종료",),
+                "artifacts": {"rpc_sqls": []},
+            }
+
+    # 지급 이후 단계는 대부분 "예"/조회 입력 → 기간·날짜 단서가 있을 때만 슬롯 추출
+    if early or _SLOT_HINT.search(user_text):
+        scanned = scan_slots(user_text)
+        period = scanned["period"]
+        scope = scanned["scope"]
+        any_date = scanned["date"]
+
+        if period:
+            slots["period"] = period
+        if scope:
+            slots["scope"] = scope
+
+        if any_date:
+            if any(w in user_text for w in _JOURNAL_DATE_WORDS):
+                slots["journal_date_raw"] = any_date
+            else:
+                slots["pay_date_raw"] = any_date
+
+    ctx["slots"] = slots
+
+    handler = _STATE_HANDLERS.get(state, _handle_reset)
+    return handler(ctx, user_text, confirm)
+
+
+
 # =====================================================
 # 7) 헤더
 # =====================================================
@@ -1710,10 +2467,15 @@ with st.sidebar:
 
     if st.button("🗑️ 대화 기록 지우기", key="sidebar_clear_chat", use_container_width=True):
         st.session_state.messages = []
+        st.session_state.pop("history_lines", None)
         st.session_state.action_suggestions = []
         st.session_state.pending_question = None
         st.rerun()
 
+    if st.button("🔄 직원 목록 새로고침", key="sidebar_refresh_employees", use_container_width=True):
+        fetch_active_employees.clear()
+        st.success("직원 검색 캐시를 비웠습니다.")
+
 # =====================================================
 # 🔀 조회 / RPC 실행 모드 선택
 # =====================================================
@@ -1743,7 +2505,8 @@ if ctx_rpc and ctx_rpc.get("active_scenario") == RPC_ACTIVE:
 # 9) 대표 질문
 # =====================================================
 # 추천 질문(칩) UI 표시 & 클릭 시 질문 입력란에 자동 반영
-chip_questions = [
+# (상수 문자열 tuple → 리런마다 리스트를 새로 만들지 않고 컴파일 시 상수 하나로 고정)
+CHIP_QUESTIONS = (
     "부서별 재직 인원수는?",
     "최근 30일 신규 입사자는 누구야?",
     "최근 90일 퇴사자는 누구야?",
@@ -1755,14 +2518,23 @@ chip_questions = [
     "2025년 12월 직급별 평균 실수령은?",
     "2025년 12월 부서별 실수령 총액은?",
     "2026년 1월 전직원 급여 처리해줘",
-]
+)
+
 
-cols = st.columns(2)
-for i, q in enumerate(chip_questions):
-    with cols[i % 2]:
-        if st.button(q, use_container_width=True, key=f"chip_{i}"):
-            st.session_state.pending_question = q
-            st.rerun()
+def _on_chip_selected():
+    # 선택값을 질문으로 넘기고 pills 선택은 해제 (같은 칩 재클릭 가능하도록)
+    st.session_state.pending_question = st.session_state.chip_pills
+    st.session_state.chip_pills = None
+
+
+# 11개 버튼 대신 단일 pills 위젯 → 프론트엔드 diff/이벤트 1회, 콜백에서 처리하므로 추가 st.rerun 없음
+st.pills(
+    "대표 질문",
+    CHIP_QUESTIONS,
+    key="chip_pills",
+    on_change=_on_chip_selected,
+    label_visibility="collapsed",
+)
 
 st.divider()
 
@@ -1788,9 +2560,9 @@ def _render_pdf_file_preview(file_path):
         return
     
     try:
-        with open(file_path, "rb") as f:
-            pdf_bytes = f.read()
-        pdf_preview(pdf_bytes)
+        stat = os.stat(file_path)
+        pdf_bytes, pdf_sha1 = _load_pdf_file(file_path, stat.st_mtime_ns, stat.st_size)
+        pdf_preview(pdf_bytes, pdf_sha1=pdf_sha1)
         st.download_button(
             "⬇️ PDF 다운로드",
             data=pdf_bytes,
@@ -1851,6 +2623,10 @@ for i, t in enumerate(turns):
                 with st.expander("🔎 실행된 SQL", expanded=expand_this):
                     st.code(t["assistant"]["sql"], language="sql")
 
+# 이번 run에서 스트리밍할 새 turn 자리 (히스토리 바로 아래, 액션 칩 위)
+#   - 끝의 st.rerun 후에는 히스토리의 같은 위치에 그대로 다시 그려져 위치가 튀지 않음
+live_turn = st.container()
+
 st.markdown('<div id="result-anchor"></div>', unsafe_allow_html=True)
 run_scroll_if_requested()
 
@@ -1883,16 +2659,31 @@ elif user_input:
 if question:
     # -------------------------------------------------
     # (A) user 메시지 기록
+    #   - 재작성기에 넘길 이력은 이번 질문을 넣기 전에 잡아둠
     # -------------------------------------------------
-    st.session_state.messages.append({
+    prior_history = format_history()
+    append_message({
         "role": "user",
         "content": question
     })
 
     # -------------------------------------------------
     # (B) 🧠 Decision Type Classifier
+    #   - 조회 모드에서 재작성이 필요하면 분류기와 재작성기를 동시에 호출
+    #   - 지시어 없는 독립 질문은 재작성기 왕복 생략
     # -------------------------------------------------
-    decision = classify_decision(question)
+    execute_mode = st.session_state.get("rpc_execute_mode", False)
+
+    history_str = None
+    if (
+        not execute_mode
+        and not is_employment_cert_trigger(question)
+        and prior_history
+        and needs_rewrite(question)
+    ):
+        history_str = prior_history
+
+    decision, rewritten_question = classify_and_rewrite(question, history_str)
     intent = decision.get("intent")
     decision_type = decision.get("decision_type")
 
@@ -1902,8 +2693,6 @@ if question:
         decision_type=decision_type
     )
 
-    execute_mode = st.session_state.get("rpc_execute_mode", False)
-
     agent_progress = None
     skip_data_query = False
 
@@ -1926,7 +2715,7 @@ if question:
             "agent_progress": agent_progress
         }
 
-        st.session_state.messages.append(assistant_msg)
+        append_message(assistant_msg)
         request_scroll("result-anchor")
         st.rerun()   # 🔥 여기서 반드시 종료
 
@@ -1995,32 +2784,38 @@ if question:
         # (2) 조회 모드: LLM SQL
         # -------------------------------------------------
         else:
-            with st.spinner("처리 중... (질문 해석 → SQL → 요약)"):
+            with st.spinner("처리 중... (질문 해석 → SQL)"):
                 hr = ensure_hr_engine()
 
-                real_question = question
-                if len(st.session_state.messages) > 1:
-                    rewriter = get_rewriter(api_key)
-                    history_str = format_history(st.session_state.messages[:-1])
-                    real_question = rewriter.invoke({
-                        "history": history_str,
-                        "question": question
-                    })
-
-                out = hr.run(real_question)
-                fixed_sql = out.get("fixed_sql") or ""
-                raw_sql = out.get("raw_sql")
+                # 재작성 결과는 (B) 단계에서 분류기와 함께 병렬로 받아둠
+                real_question = rewritten_question or question
 
-                patched_sql = enforce_month_range_sql(fixed_sql)
-                patched_result = exec_sql(patched_sql)
-
-                answer = explainer.invoke({
-                    "question": real_question,
-                    "result": patched_result
-                })
-
-                sql_to_show = patched_sql
-                raw_sql_to_show = fixed_sql if raw_sql is None else raw_sql
+                # 공백/문장부호만 다른 같은 질문은 TTL(5분) 동안 SQL 생성·실행·요약을 통째로 재사용
+                response_cache = get_response_cache(ENGINE_VERSION)
+                answer_key = ("answer", _question_key(real_question))
+                hit = response_cache.get(answer_key)
+                if hit is not None:
+                    answer, sql_to_show, raw_sql_to_show = hit
+                else:
+                    # 엔진이 pay_month 범위 보정까지 마친 SQL만 받아 아래에서 한 번만 실행
+                    out = hr.run(real_question, execute=False)
+                    fixed_sql = out.get("fixed_sql") or ""
+                    raw_sql_to_show = out.get("raw_sql")
+
+                    patched_result = exec_sql(fixed_sql)
+
+            # 요약은 스피너 밖에서 스트리밍 → 첫 토큰부터 바로 표시 (최종 문자열은 메시지로 저장)
+            if hit is None:
+                with live_turn:
+                    with st.chat_message("user"):
+                        st.markdown(question)
+                    with st.chat_message("assistant"):
+                        answer = stream_explanation(real_question, truncate_result(patched_result))
+
+                sql_to_show = fixed_sql
+                # DB 오류 결과는 일시적일 수 있으므로 캐시하지 않음
+                if not isinstance(patched_result, str):
+                    response_cache[answer_key] = (answer, sql_to_show, raw_sql_to_show)
 
     except Exception as e:
         answer = f"❌ 오류: {e}"
@@ -2042,7 +2837,7 @@ if question:
     if file_path_to_save:
         assistant_msg["file_path"] = file_path_to_save
 
-    st.session_state.messages.append(assistant_msg)
+    append_message(assistant_msg)
 
     request_scroll("result-anchor")
     st.rerun()
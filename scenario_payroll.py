@@ -7,9 +7,10 @@ from __future__ import annotations
 
 import re
 import uuid
-import ast
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from datetime import date
+from enum import IntEnum
 from typing import Any, Dict, Optional, List, Tuple
 
 
@@ -18,46 +19,22 @@ from typing import Any, Dict, Optional, List, Tuple
 # -----------------------------
 def _to_rows(result):
     """
-    QuerySQLDatabaseTool 결과는 보통 문자열로 옵니다.
-    예) "[(26, Decimal('92082741'), Decimal('7611337'), 0)]"
-    Decimal(...) 같은 표현 때문에 literal_eval이 실패할 수 있어서 정규화 후 파싱합니다.
+    sql_engine.run() 결과를 행(튜플) 리스트로 정규화.
+    엔진이 드라이버 행을 그대로 돌려주므로 문자열 재파싱은 하지 않고,
+    문자열(실행 오류 메시지 등)이나 None은 빈 결과로 취급합니다.
     """
-    if result is None:
-        return []
-
     if isinstance(result, (list, tuple)):
         return list(result)
-
-    if isinstance(result, str):
-        s = result.strip()
-
-        # Decimal('123') -> 123
-        s = re.sub(r"Decimal\('(-?\d+(?:\.\d+)?)'\)", r"\1", s)
-        # Decimal("123") -> 123
-        s = re.sub(r'Decimal\("(-?\d+(?:\.\d+)?)"\)', r"\1", s)
-        # NULL -> None
-        s = s.replace("NULL", "None")
-
-        try:
-            v = ast.literal_eval(s)
-            if isinstance(v, (list, tuple)):
-                return list(v)
-            return [v]
-        except Exception:
-            # fallback: numeric tokens
-            nums = re.findall(r"-?\d+(?:\.\d+)?", s)
-            if nums:
-                row = []
-                for x in nums:
-                    row.append(int(x) if re.fullmatch(r"-?\d+", x) else float(x))
-                return [tuple(row)]
-            return []
-
     return []
 
 
 def _fmt_won(n):
+    # 대부분 이미 정수로 들어오므로 변환/예외 처리 없이 바로 포맷
+    if isinstance(n, int):
+        return f"{n:,}원"
     try:
+        if isinstance(n, float):
+            return f"{int(n):,}원"
         return f"{int(float(n)):,}원"
     except Exception:
         return str(n)
@@ -72,22 +49,42 @@ class ScenarioMemoryManager:
     - default store: in-memory dict
     - you can pass streamlit.session_state (dict-like) as store
       e.g. ScenarioMemoryManager(store=st.session_state)
+    - bounded: least-recently-used sessions beyond max_sessions are evicted,
+      and each context keeps only the last max_history history entries
     """
-    def __init__(self, store: Optional[dict] = None, namespace: str = "scenario_mem"):
+    def __init__(
+        self,
+        store: Optional[dict] = None,
+        namespace: str = "scenario_mem",
+        max_sessions: int = 256,
+        max_history: int = 20,
+    ):
         self._external_store = store
         self._namespace = namespace
+        self._max_sessions = max_sessions
+        self._max_history = max_history
         if self._external_store is None:
-            self._mem: Dict[str, dict] = {}
+            self._mem: Dict[str, dict] = OrderedDict()
         else:
-            if namespace not in self._external_store:
-                self._external_store[namespace] = {}
+            existing = self._external_store.get(namespace)
+            if not isinstance(existing, OrderedDict):
+                self._external_store[namespace] = OrderedDict(existing or {})
             self._mem = self._external_store[namespace]
 
     def get(self, session_id: str) -> dict:
+        if session_id in self._mem:
+            self._mem.move_to_end(session_id)
         return self._mem.get(session_id, {})
 
     def set(self, session_id: str, data: dict) -> None:
+        history = data.get("history")
+        if isinstance(history, list) and len(history) > self._max_history:
+            data["history"] = history[-self._max_history:]
+
         self._mem[session_id] = data
+        self._mem.move_to_end(session_id)
+        while len(self._mem) > self._max_sessions:
+            self._mem.popitem(last=False)
 
     def clear(self, session_id: str) -> None:
         if session_id in self._mem:
@@ -99,11 +96,31 @@ class ScenarioMemoryManager:
 # -----------------------------
 TODAY = date(2026, 1, 8)  # align with your prompt rule
 
-STATE_PAYROLL_CALC = "PAYROLL_CALC"
-STATE_TAX_CALC = "TAX_CALC"         # 실제 의미: 공제 검증/요약
-STATE_PAYMENT_RUN = "PAYMENT_RUN"
-STATE_JOURNAL_POST = "JOURNAL_POST"
-STATE_DONE = "DONE"
+class PayrollState(IntEnum):
+    PAYROLL_CALC = 0
+    TAX_CALC = 1        # 실제 의미: 공제 검증/요약
+    PAYMENT_RUN = 2
+    JOURNAL_POST = 3
+    DONE = 4
+
+
+# display labels, indexed by PayrollState value
+STATE_LABELS = ("급여 산정", "공제 검증", "지급 처리", "전표 생성", "완료")
+
+STATE_PAYROLL_CALC = PayrollState.PAYROLL_CALC
+STATE_TAX_CALC = PayrollState.TAX_CALC
+STATE_PAYMENT_RUN = PayrollState.PAYMENT_RUN
+STATE_JOURNAL_POST = PayrollState.JOURNAL_POST
+STATE_DONE = PayrollState.DONE
+
+
+def _coerce_state(v) -> Optional[PayrollState]:
+    """stored value (int, or legacy state name) -> PayrollState"""
+    if isinstance(v, int):
+        return PayrollState(v)
+    if isinstance(v, str) and v in PayrollState.__members__:
+        return PayrollState[v]
+    return None
 
 ACTIVE_SCENARIO = "PAYROLL_E2E"
 
@@ -111,7 +128,7 @@ ACTIVE_SCENARIO = "PAYROLL_E2E"
 @dataclass
 class ScenarioContext:
     active_scenario: str = ""
-    state: str = ""
+    state: Optional[PayrollState] = None
     slots: Dict[str, Any] = field(default_factory=dict)
     refs: Dict[str, Any] = field(default_factory=dict)
     history: List[Dict[str, Any]] = field(default_factory=list)
@@ -119,7 +136,7 @@ class ScenarioContext:
     def to_dict(self) -> dict:
         return {
             "active_scenario": self.active_scenario,
-            "state": self.state,
+            "state": None if self.state is None else int(self.state),
             "slots": self.slots,
             "refs": self.refs,
             "history": self.history,
@@ -129,7 +146,7 @@ class ScenarioContext:
     def from_dict(d: dict) -> "ScenarioContext":
         return ScenarioContext(
             active_scenario=d.get("active_scenario", ""),
-            state=d.get("state", ""),
+            state=_coerce_state(d.get("state")),
             slots=dict(d.get("slots", {}) or {}),
             refs=dict(d.get("refs", {}) or {}),
             history=list(d.get("history", []) or []),
@@ -139,33 +156,51 @@ class ScenarioContext:
 # -----------------------------
 # 2) Slot Extractor (minimal rule-based)
 # -----------------------------
+# 매 턴 호출되는 추출 패턴은 import 시 한 번만 컴파일
+_PERIOD_YMD = re.compile(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])\b")
+_PERIOD_KR = re.compile(r"\b(20\d{2})\s*년\s*(0?[1-9]|1[0-2])\s*월\b")
+_MONTH_ONLY = re.compile(r"\b(0?[1-9]|1[0-2])\s*월\b")
+_THIS_MONTH = re.compile(r"(이번\s*달|당월|이번달)")
+_LAST_MONTH = re.compile(r"(지난\s*달|전월|지난달)")
+
+_SCOPE_ALL = re.compile(r"(전\s*직원|전체\s*직원|전체|전사|모두)")
+_SCOPE_DEPT = re.compile(r"\b([가-힣A-Za-z0-9_]+)\s*(부|팀)\b")
+_SCOPE_EMP = re.compile(r"\b([가-힣]{2,4})\b")
+_SCOPE_EMP_STOPWORDS = re.compile(r"(급여|세금|지급|전표|이번|지난|월|년|공제)")
+
+_DATE_YMD = re.compile(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])[-./](0?[1-9]|[12]\d|3[01])\b")
+_DATE_MD = re.compile(r"\b(0?[1-9]|1[0-2])\s*/\s*(0?[1-9]|[12]\d|3[01])\b")
+_DATE_DAY = re.compile(r"\b(0?[1-9]|[12]\d|3[01])\s*일\b")
+_PAY_WORDS = re.compile(r"(지급|이체|송금)")
+
+
 def _extract_period(text: str) -> Optional[str]:
     t = text.strip()
 
     # yyyy-mm
-    m = re.search(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])\b", t)
+    m = _PERIOD_YMD.search(t)
     if m:
         y = m.group(1)
         mm = int(m.group(2))
         return f"{y}-{mm:02d}"
 
     # yyyy년 n월
-    m = re.search(r"\b(20\d{2})\s*년\s*(0?[1-9]|1[0-2])\s*월\b", t)
+    m = _PERIOD_KR.search(t)
     if m:
         y = m.group(1)
         mm = int(m.group(2))
         return f"{y}-{mm:02d}"
 
     # n월 (assume current year in TODAY)
-    m = re.search(r"\b(0?[1-9]|1[0-2])\s*월\b", t)
+    m = _MONTH_ONLY.search(t)
     if m:
         mm = int(m.group(1))
         return f"{TODAY.year}-{mm:02d}"
 
-    if re.search(r"(이번\s*달|당월|이번달)", t):
+    if _THIS_MONTH.search(t):
         return f"{TODAY.year}-{TODAY.month:02d}"
 
-    if re.search(r"(지난\s*달|전월|지난달)", t):
+    if _LAST_MONTH.search(t):
         y, mth = TODAY.year, TODAY.month - 1
         if mth == 0:
             y -= 1
@@ -178,15 +213,15 @@ def _extract_period(text: str) -> Optional[str]:
 def _extract_employee_scope(text: str) -> Optional[str]:
     t = text.strip()
 
-    if re.search(r"(전\s*직원|전체\s*직원|전체|전사|모두)", t):
+    if _SCOPE_ALL.search(t):
         return "ALL"
 
-    m = re.search(r"\b([가-힣A-Za-z0-9_]+)\s*(부|팀)\b", t)
+    m = _SCOPE_DEPT.search(t)
     if m:
         return f"dept:{m.group(1)}{m.group(2)}"
 
-    m = re.search(r"\b([가-힣]{2,4})\b", t)
-    if m and not re.search(r"(급여|세금|지급|전표|이번|지난|월|년|공제)", m.group(1)):
+    m = _SCOPE_EMP.search(t)
+    if m and not _SCOPE_EMP_STOPWORDS.search(m.group(1)):
         return f"emp:{m.group(1)}"
 
     return None
@@ -195,29 +230,45 @@ def _extract_employee_scope(text: str) -> Optional[str]:
 def _extract_pay_date(text: str) -> Optional[str]:
     t = text.strip()
 
-    m = re.search(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])[-./](0?[1-9]|[12]\d|3[01])\b", t)
+    m = _DATE_YMD.search(t)
     if m:
         y = int(m.group(1))
         mm = int(m.group(2))
         dd = int(m.group(3))
         return f"{y}-{mm:02d}-{dd:02d}"
 
-    m = re.search(r"\b(0?[1-9]|[12]\d|3[01])\s*일\b", t)
-    if m and re.search(r"(지급|이체|송금)", t):
+    m = _DATE_DAY.search(t)
+    if m and _PAY_WORDS.search(t):
         return f"__DAY__:{int(m.group(1))}"
 
     return None
 
 
+_CONFIRM_YES = frozenset(("예", "네", "응", "진행", "실행", "확정", "ok", "ㅇㅋ"))
+_CONFIRM_NO = frozenset(("아니오", "아니", "취소", "중단", "no", "ㄴㄴ"))
+
+
 def _extract_confirm(text: str) -> Optional[bool]:
-    t = text.strip()
-    if re.fullmatch(r"(예|네|응|진행|실행|확정|ok|ㅇㅋ)", t, flags=re.IGNORECASE):
+    t = text.strip().lower()
+    if t in _CONFIRM_YES:
         return True
-    if re.fullmatch(r"(아니오|아니|취소|중단|no|ㄴㄴ)", t, flags=re.IGNORECASE):
+    if t in _CONFIRM_NO:
         return False
     return None
 
 
+# intent 키워드는 모두 고정 문자열 → 정규식 대신 부분 문자열 검사 (뒤에 있는 intent가 우선)
+#   - '급여처리/급여 계산/급여 산정', '공제금액'은 각각 '급여', '공제'에 포함되므로 생략
+_INTENT_KEYWORDS = (
+    ("PAYROLL", ("급여",)),
+    ("TAX", ("세금", "원천세", "4대보험", "보험료", "공제")),
+    ("PAYMENT", ("지급", "이체", "송금")),
+    ("JOURNAL", ("전표", "분개", "전기", "회계")),
+    ("EXIT", ("취소", "종료", "그만", "중단", "처음부터", "리셋", "초기화")),
+)
+_PAYROLL_TRIGGER_KEYWORDS = ("급여", "원천세", "4대보험", "지급", "전표", "공제")
+
+
 def extract_slots(text: str) -> Dict[str, Any]:
     slots: Dict[str, Any] = {}
     p = _extract_period(text)
@@ -237,16 +288,9 @@ def extract_slots(text: str) -> Dict[str, Any]:
         slots["confirm"] = conf
 
     # intent flags
-    if re.search(r"(급여|급여처리|급여\s*계산|급여\s*산정)", text):
-        slots["intent"] = "PAYROLL"
-    if re.search(r"(세금|원천세|4대보험|보험료|공제|공제금액)", text):
-        slots["intent"] = "TAX"
-    if re.search(r"(지급|이체|송금)", text):
-        slots["intent"] = "PAYMENT"
-    if re.search(r"(전표|분개|전기|회계)", text):
-        slots["intent"] = "JOURNAL"
-    if re.search(r"(취소|종료|그만|중단|처음부터|리셋|초기화)", text):
-        slots["intent"] = "EXIT"
+    for intent, keywords in _INTENT_KEYWORDS:
+        if any(k in text for k in keywords):
+            slots["intent"] = intent
 
     return slots
 
@@ -300,15 +344,16 @@ class PayrollScenario:
         if intent:
             self._maybe_jump_state(ctx, intent)
 
-        out = self._handle_state(ctx, sql_engine, confirm)
-
-        self.memory.set(session_id, ctx.to_dict())
-        return out
+        # 상태 처리 중 예외(SQL 차단 등)가 나도 이번 턴의 슬롯/상태 변경은 한 번의 쓰기로 반영
+        try:
+            return self._handle_state(ctx, sql_engine, confirm)
+        finally:
+            self.memory.set(session_id, ctx.to_dict())
 
     def _is_payroll_trigger(self, text: str, slots: Dict[str, Any], ctx: ScenarioContext) -> bool:
         if ctx.active_scenario == ACTIVE_SCENARIO:
             return True
-        return bool(re.search(r"(급여|원천세|4대보험|지급|전표|공제)", text))
+        return any(k in text for k in _PAYROLL_TRIGGER_KEYWORDS)
 
     def _maybe_jump_state(self, ctx: ScenarioContext, intent: str) -> None:
         if intent == "PAYROLL":
@@ -330,23 +375,12 @@ class PayrollScenario:
 
     # ---- state handling ----
     def _handle_state(self, ctx: ScenarioContext, sql_engine, confirm: Optional[bool]) -> dict:
-        if ctx.state == STATE_PAYROLL_CALC:
-            return self._state_payroll_calc(ctx, sql_engine)
-
-        if ctx.state == STATE_TAX_CALC:
-            return self._state_tax_calc(ctx, sql_engine)
-
-        if ctx.state == STATE_PAYMENT_RUN:
-            return self._state_payment_run(ctx, sql_engine, confirm)
-
-        if ctx.state == STATE_JOURNAL_POST:
-            return self._state_journal_post(ctx, sql_engine, confirm)
-
-        if ctx.state == STATE_DONE:
-            return self._state_done(ctx)
-
-        ctx.state = STATE_PAYROLL_CALC
-        return self._state_payroll_calc(ctx, sql_engine)
+        # state -> handler 테이블 조회 (알 수 없는 상태는 급여 산정부터 다시)
+        handler = _STATE_HANDLERS.get(ctx.state)
+        if handler is None:
+            ctx.state = STATE_PAYROLL_CALC
+            handler = PayrollScenario._state_payroll_calc
+        return handler(self, ctx, sql_engine, confirm)
 
     def _require(self, ctx: ScenarioContext, keys: List[str]) -> Tuple[bool, List[str]]:
         missing = [k for k in keys if not ctx.slots.get(k)]
@@ -358,7 +392,7 @@ class PayrollScenario:
     # -----------------------------
     # STATE 1) PAYROLL_CALC
     # -----------------------------
-    def _state_payroll_calc(self, ctx: ScenarioContext, sql_engine) -> dict:
+    def _state_payroll_calc(self, ctx: ScenarioContext, sql_engine, confirm: Optional[bool] = None) -> dict:
         ok, missing = self._require(ctx, ["period", "employee_scope"])
         if not ok:
             reply = (
@@ -425,7 +459,7 @@ class PayrollScenario:
     # -----------------------------
     # STATE 2) TAX_CALC (공제 검증)
     # -----------------------------
-    def _state_tax_calc(self, ctx: ScenarioContext, sql_engine) -> dict:
+    def _state_tax_calc(self, ctx: ScenarioContext, sql_engine, confirm: Optional[bool] = None) -> dict:
         ok, missing = self._require(ctx, ["period"])
         if not ok:
             return {
@@ -612,12 +646,12 @@ class PayrollScenario:
         last_text = ctx.slots.get("_last_user_text", "")
 
         if not ctx.slots.get("journal_date"):
-            m = re.search(r"\b(20\d{2})[-./](0?[1-9]|1[0-2])[-./](0?[1-9]|[12]\d|3[01])\b", last_text)
+            m = _DATE_YMD.search(last_text)
             if m:
                 y = int(m.group(1)); mm = int(m.group(2)); dd = int(m.group(3))
                 ctx.slots["journal_date"] = f"{y}-{mm:02d}-{dd:02d}"
             else:
-                m = re.search(r"\b(0?[1-9]|1[0-2])\s*/\s*(0?[1-9]|[12]\d|3[01])\b", last_text)
+                m = _DATE_MD.search(last_text)
                 if m:
                     mm = int(m.group(1)); dd = int(m.group(2))
                     y = int(period.split("-")[0])
@@ -682,7 +716,7 @@ class PayrollScenario:
     # -----------------------------
     # DONE
     # -----------------------------
-    def _state_done(self, ctx: ScenarioContext) -> dict:
+    def _state_done(self, ctx: ScenarioContext, sql_engine=None, confirm: Optional[bool] = None) -> dict:
         lines = [
             "✅ 급여 E2E 시나리오 완료 요약:",
             f"- period: {ctx.slots.get('period')}",
@@ -694,10 +728,20 @@ class PayrollScenario:
         ]
         # soft clear
         ctx.active_scenario = ""
-        ctx.state = ""
+        ctx.state = None
         return {"handled": True, "reply": "\n".join(lines), "state": None, "suggestions": ["처음부터 다시", "취소(시나리오 종료)"]}
 
 
+# state -> handler (모든 _state_* 메서드는 (self, ctx, sql_engine, confirm) 공통 시그니처)
+_STATE_HANDLERS = {
+    STATE_PAYROLL_CALC: PayrollScenario._state_payroll_calc,
+    STATE_TAX_CALC: PayrollScenario._state_tax_calc,
+    STATE_PAYMENT_RUN: PayrollScenario._state_payment_run,
+    STATE_JOURNAL_POST: PayrollScenario._state_journal_post,
+    STATE_DONE: PayrollScenario._state_done,
+}
+
+
 # -----------------------------
 # 4) Orchestrator
 # -----------------------------
@@ -705,9 +749,11 @@ class ScenarioOrchestrator:
     """
     Routes user input to scenario first, otherwise falls back to raw SQL engine.
     """
-    def __init__(self, sql_engine, scenarios: List[PayrollScenario]):
+    def __init__(self, sql_engine, scenarios: List[PayrollScenario], fallback_run=None):
         self.sql_engine = sql_engine
         self.scenarios = scenarios
+        # optional (question -> artifacts) hook for the fallback path, e.g. a cached run
+        self.fallback_run = fallback_run or sql_engine.run
 
     def run(self, session_id: str, user_text: str) -> dict:
         for s in self.scenarios:
@@ -716,7 +762,7 @@ class ScenarioOrchestrator:
                 return out
 
         # fallback
-        res = self.sql_engine.run(user_text)
+        res = self.fallback_run(user_text)
         return {
             "handled": True,
             "reply": "요청을 실행했습니다.",